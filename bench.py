@@ -0,0 +1,505 @@
+# ローカル負荷試験。ticket.py のハンドラーを同じプロセス内の偽Discord（REST + ゲートウェイ）に対して実行し、
+# スループット・p50/p99レイテンシ・ピークRSSを表示する。本物のDiscordには一切接続しない
+#   python bench.py                                   全シナリオを実行
+#   python bench.py --scenario panel --guilds 200     パネルからの一斉作成だけ
+#   python bench.py --latency 0.05 --jitter 0.05 --rate-limit 0.05   RESTの遅延と429を注入する
+#   python bench.py --scenario startup --members 20000 [--low-memory]   起動（メンバー取得）にかかる時間とメモリ
+from aiohttp import web
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windowsではピークメモリを表示しない
+    resource = None
+
+import discord
+
+ids = itertools.count(10 ** 17)
+
+def snowflake():
+    return next(ids)
+
+def user_payload(user_id, name, bot=False):
+    return {"id": str(user_id), "username": name, "discriminator": "0", "global_name": name, "avatar": None, "bot": bot}
+
+def channel_payload(channel_id, guild_id, name, type=0, parent_id=None, overwrites=None):
+    return {
+        "id": str(channel_id), "guild_id": str(guild_id), "name": name, "type": type, "position": 0,
+        "parent_id": str(parent_id) if parent_id else None, "permission_overwrites": overwrites or [],
+        "nsfw": False, "topic": None, "last_message_id": None, "rate_limit_per_user": 0, "flags": 0
+    }
+
+class FakeDiscord:
+    # REST APIの代わりをするaiohttpサーバー。作成・削除したチャンネルはゲートウェイイベントとしてBotに流し込む
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, retry_after=0.05):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.bot = None
+        self.base = None
+        self.runner = None
+        self.app_id = snowflake()
+        self.bot_user = user_payload(snowflake(), "ticketbot", bot=True)
+        self.channels = {}
+        self.member_counts = {}
+        self.tasks = set()
+        self.calls = {}
+        self.rate_limited = 0
+        # 計測点: (種類, interactionのtoken または channel_id) -> 最初に成功した時刻
+        self.marks = {}
+        # interactionのtoken -> 応答かフォローアップとして作られた最後のメッセージ（付いたViewを操作する時に使う）
+        self.responses = {}
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self.handler)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        discord.http.Route.BASE = f"{self.base}/api/v10"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handler(self, request):
+        path = request.path.split("/api/v10", 1)[1]
+        key = request.method + " " + re.sub(r"/[0-9]{5,}", "/{id}", re.sub(r"/(interactions|webhooks)/([0-9]+)/[^/]+", r"/\1/{id}/{token}", path))
+        self.calls[key] = self.calls.get(key, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        if self.rate_limit and random.random() < self.rate_limit and not path.startswith(("/users/@me", "/oauth2")):
+            self.rate_limited += 1
+            return web.Response(
+                status=429,
+                body=json.dumps({"message": "You are being rate limited.", "retry_after": self.retry_after, "global": False}),
+                headers={
+                    "Content-Type": "application/json", "Retry-After": str(self.retry_after), "X-RateLimit-Scope": "user",
+                    "X-RateLimit-Bucket": "fake", "X-RateLimit-Limit": "5", "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": str(self.retry_after),
+                    # Viaのない429はCloudflareによる遮断とみなされ、Webhook側では再試行されない
+                    "Via": "1.1 google"
+                }
+            )
+        body = await self.read_body(request)
+        result = self.route(request.method, path, body, request)
+        self.mark(request.method, path)
+        if result is None:
+            return web.Response(status=204)
+        return web.Response(body=json.dumps(result), headers={"Content-Type": "application/json"})
+
+    async def read_body(self, request):
+        if not request.can_read_body:
+            return {}
+        if request.content_type.startswith("multipart"):
+            body = {}
+            reader = await request.multipart()
+            while (part := await reader.next()) is not None:
+                if part.name == "payload_json":
+                    body = json.loads(await part.text())
+                else:
+                    await part.read()
+            return body
+        raw = await request.read()
+        return json.loads(raw) if raw else {}
+
+    def mark(self, method, path):
+        parts = path.split("/")[1:]
+        now = time.perf_counter()
+        if parts[0] == "interactions":
+            self.marks.setdefault(("ack", parts[2]), now)
+        elif parts[0] == "webhooks" and method == "POST":
+            self.marks.setdefault(("followup", parts[2]), now)
+        elif parts[0] == "channels" and len(parts) == 2 and method == "DELETE":
+            self.marks.setdefault(("delete", int(parts[1])), now)
+
+    def route(self, method, path, body, request):
+        parts = path.split("/")[1:]
+        if path == "/users/@me":
+            return self.bot_user
+        if path == "/oauth2/applications/@me":
+            return {
+                "id": str(self.app_id), "name": "ticketbot", "icon": None, "description": "", "bot_public": True,
+                "bot_require_code_grant": False, "verify_key": "x", "owner": user_payload(1, "owner"),
+                "flags": 0, "summary": "", "team": None, "interactions_endpoint_url": None
+            }
+        if path == "/users/@me/channels":
+            return {"id": str(snowflake()), "type": 1, "recipients": [user_payload(int(body["recipient_id"]), "user")], "last_message_id": None}
+        if parts[0] == "applications":
+            return []
+        if parts[0] == "guilds" and parts[-1] == "channels" and method == "POST":
+            payload = channel_payload(
+                snowflake(), int(parts[1]), body["name"], body.get("type", 0), body.get("parent_id"), body.get("permission_overwrites")
+            )
+            self.channels[int(payload["id"])] = payload
+            self.feed("channel_create", payload)
+            return payload
+        if parts[0] == "guilds" and len(parts) == 4 and parts[2] == "members":
+            return self.member_payload(int(parts[3]))
+        if parts[0] == "guilds":
+            return []
+        if parts[0] == "channels" and len(parts) == 2:
+            return self.channel_route(method, int(parts[1]), body)
+        if parts[0] == "channels" and parts[-1] == "messages":
+            return self.message_payload(int(parts[1]), body) if method == "POST" else []
+        if parts[0] == "interactions":
+            message = self.responses[parts[2]] = self.message_payload(0, body.get("data") or {})
+            if request.query.get("with_response"):
+                return {
+                    "interaction": {
+                        "id": parts[1], "type": 3, "response_message_id": message["id"],
+                        "response_message_loading": body.get("type") == 5, "response_message_ephemeral": True
+                    },
+                    "resource": {"type": body.get("type", 4), "message": message}
+                }
+            return None
+        if parts[0] == "webhooks":
+            # 応答を保留した後はフォローアップのメッセージにViewが付く
+            message = self.message_payload(0, body)
+            if method == "POST":
+                self.responses[parts[2]] = message
+            return message
+        return None
+
+    def channel_route(self, method, channel_id, body):
+        payload = self.channels.get(channel_id)
+        if payload is None:
+            return None
+        if method == "DELETE":
+            del self.channels[channel_id]
+            self.feed("channel_delete", payload)
+        elif method == "PATCH":
+            payload = self.channels[channel_id] = {
+                **payload, **{key: body[key] for key in ("name", "permission_overwrites") if key in body}
+            }
+            self.feed("channel_update", payload)
+        return payload
+
+    def message_payload(self, channel_id, body):
+        embeds = json.loads(json.dumps(body.get("embeds") or []))
+        attachments = []
+        for attachment in body.get("attachments") or []:
+            url = f"{self.base}/cdn/attachments/{channel_id}/{snowflake()}/{attachment['filename']}"
+            attachments.append({"id": str(snowflake()), "filename": attachment["filename"], "size": 1, "url": url, "proxy_url": url})
+            for embed in embeds:
+                if embed.get("image", {}).get("url") == f"attachment://{attachment['filename']}":
+                    embed["image"] = {"url": url, "proxy_url": url}
+        return {
+            "id": str(snowflake()), "channel_id": str(channel_id), "author": self.bot_user, "content": body.get("content") or "",
+            "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None, "tts": False, "mention_everyone": False,
+            "mentions": [], "mention_roles": [], "attachments": attachments, "embeds": embeds, "pinned": False, "type": 0,
+            "components": body.get("components") or [], "flags": body.get("flags") or 0
+        }
+
+    def member_payload(self, user_id):
+        return {"user": user_payload(user_id, f"user{user_id}"), "roles": [], "joined_at": "2024-01-01T00:00:00+00:00",
+                "deaf": False, "mute": False, "flags": 0}
+
+    def guild_payload(self, guild_id, members=0):
+        category = channel_payload(snowflake(), guild_id, "tickets", type=4)
+        self.channels[int(category["id"])] = category
+        self.member_counts[guild_id] = members
+        return {
+            "id": str(guild_id), "name": f"guild-{guild_id}", "icon": None, "owner_id": "1",
+            "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0, "hoist": False,
+                       "managed": False, "mentionable": False, "flags": 0}],
+            "emojis": [], "stickers": [], "features": [], "member_count": members + 1, "large": members + 1 > 250, "channels": [category],
+            "threads": [], "members": [self.member_payload(int(self.bot_user["id"]))], "voice_states": [], "presences": [],
+            "verification_level": 0, "default_message_notifications": 0, "explicit_content_filter": 0, "mfa_level": 0,
+            "premium_tier": 0, "preferred_locale": "ja", "system_channel_flags": 0, "nsfw_level": 0,
+            "premium_progress_bar_enabled": False, "unavailable": False
+        }
+
+    def interaction(self, guild_id, user_id, data, channel_id, message):
+        interaction_id = snowflake()
+        token = f"tok{interaction_id}"
+        payload = {
+            "id": str(interaction_id), "application_id": str(self.app_id), "type": 3, "token": token, "version": 1,
+            "guild_id": str(guild_id), "channel_id": str(channel_id), "member": {**self.member_payload(user_id), "permissions": "8"},
+            "data": data, "app_permissions": "8", "locale": "ja", "guild_locale": "ja", "entitlements": [],
+            "authorizing_integration_owners": {}, "context": 0, "attachment_size_limit": 8388608,
+            "channel": self.channels.get(channel_id) or channel_payload(channel_id, guild_id, "panel"), "message": message
+        }
+        return token, payload
+
+    def command(self, guild_id, user_id, name, options=()):
+        # スラッシュコマンドのinteraction。options は (名前, 型, 値) の並び
+        token, payload = self.interaction(guild_id, user_id, {
+            "id": str(snowflake()), "name": name, "type": 1,
+            "options": [{"name": option, "type": type, "value": value} for option, type, value in options]
+        }, 1, None)
+        payload["type"] = 2
+        del payload["message"]
+        return token, payload
+
+    def feed(self, event, payload):
+        # ゲートウェイから届いたのと同じようにBotの状態へ反映する
+        if self.bot is not None:
+            asyncio.get_running_loop().call_soon(getattr(self.bot._connection, f"parse_{event}"), payload)
+
+    def dispatch(self, payload):
+        self.bot._connection.parse_interaction_create(payload)
+
+    async def request_chunks(self, guild_id, query=None, *, limit, user_ids=None, presences=False, nonce=None):
+        # ゲートウェイのREQUEST_GUILD_MEMBERSの代わり。1000人ずつGUILD_MEMBERS_CHUNKを返す
+        task = asyncio.create_task(self.send_chunks(guild_id, nonce))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_chunks(self, guild_id, nonce):
+        total = self.member_counts.get(guild_id, 0)
+        count = max(1, -(-total // 1000))
+        for index in range(count):
+            members = [self.member_payload(snowflake()) for _ in range(min(1000, total - index * 1000))]
+            self.bot._connection.parse_guild_members_chunk({
+                "guild_id": str(guild_id), "members": members, "chunk_index": index, "chunk_count": count, "nonce": nonce
+            })
+            await asyncio.sleep(0)
+
+    async def connect(self, bot, guilds):
+        # 偽RESTにログインし、READYとGUILD_CREATEを再生する。メンバーの取得要求にはこのオブジェクトが応える
+        self.bot = bot
+        state = bot._connection
+        state.guild_ready_timeout = 0.01
+        state._get_websocket = lambda *args, **kwargs: self
+        await bot.login("bench-token")
+        ready = asyncio.Event()
+
+        async def on_ready():
+            ready.set()
+
+        bot.add_listener(on_ready, "on_ready")
+        state.parse_ready({
+            "v": 10, "user": self.bot_user, "guilds": [{"id": guild["id"], "unavailable": True} for guild in guilds],
+            "session_id": "bench", "resume_gateway_url": "", "shard": [0, 1], "application": {"id": str(self.app_id), "flags": 0}
+        })
+        for guild in guilds:
+            state.parse_guild_create(guild)
+        await ready.wait()
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def peak_rss():
+    if resource is None:
+        return "n/a"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return f"{peak / (1024 * 1024 if sys.platform == 'darwin' else 1024):.1f} MB"
+
+def report(name, samples, elapsed):
+    if not samples:
+        print(f"  計測できた操作がありません: {name}")
+        return
+    print(
+        f"  {len(samples):>6} 件  {len(samples) / elapsed:>9.1f} 件/秒  "
+        f"p50 {percentile(samples, 50) * 1000:>8.1f} ms  p99 {percentile(samples, 99) * 1000:>8.1f} ms  {name}"
+    )
+
+def report_once(name, elapsed, rows):
+    print(f"  {rows:>6} 行  {rows / elapsed:>9.1f} 行/秒  計 {elapsed * 1000:>9.1f} ms  {name}")
+
+async def wait_marks(fake, keys, timeout):
+    deadline = time.perf_counter() + timeout
+    while not all(key in fake.marks for key in keys):
+        if time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.01)
+
+def latencies(fake, kind, started):
+    return [fake.marks[(kind, key)] - t0 for key, t0 in started.items() if (kind, key) in fake.marks]
+
+def elapsed_until(fake, kind, started, first):
+    ends = [fake.marks[(kind, key)] for key in started if (kind, key) in fake.marks]
+    return max(ends) - first if ends else 1
+
+async def panel_burst(ticket, fake, guilds, per_guild, timeout):
+    # 各サーバーのパネルで per_guild 人が同時にチケットを作成する
+    started = {}
+    first = time.perf_counter()
+    for guild in guilds:
+        view = ticket.get_template(guild, "panel")["view"]
+        select = view.children[0]
+        message = fake.message_payload(1, {"components": view.to_components()})
+        for _ in range(per_guild):
+            token, payload = fake.interaction(
+                guild.id, snowflake(), {"component_type": 3, "custom_id": select.custom_id, "values": [select.item.options[0].value]}, 1, message
+            )
+            started[token] = time.perf_counter()
+            fake.dispatch(payload)
+    await wait_marks(fake, [("followup", token) for token in started], timeout)
+    print(f"パネルからの一斉作成 ({len(guilds)} サーバー x {per_guild} 人)")
+    report("応答 (defer)", latencies(fake, "ack", started), elapsed_until(fake, "ack", started, first))
+    report("作成完了", latencies(fake, "followup", started), elapsed_until(fake, "followup", started, first))
+
+async def mass_close(ticket, fake, timeout):
+    # 開いている全チケットで同時に「はい」を押す
+    message = fake.message_payload(0, {"components": ticket.shared_view(ticket.ConfirmCloseView).to_components()})
+    started, tokens = {}, {}
+    first = time.perf_counter()
+    for (guild_id, user_id), channel_id in list(ticket.open_tickets.items()):
+        token, payload = fake.interaction(
+            guild_id, user_id, {"component_type": 2, "custom_id": "ticket:confirm_close"}, channel_id, {**message, "channel_id": str(channel_id)}
+        )
+        tokens[token] = started[channel_id] = time.perf_counter()
+        fake.dispatch(payload)
+    await wait_marks(fake, [("delete", channel_id) for channel_id in started], timeout)
+    print(f"一斉クローズ ({len(started)} チケット)")
+    report("応答", latencies(fake, "ack", tokens), elapsed_until(fake, "ack", tokens, first))
+    report("チャンネル削除", latencies(fake, "delete", started), elapsed_until(fake, "delete", started, first))
+
+def fill_settings(ticket, count):
+    guild_ids = [snowflake() for _ in range(count)]
+    rows = []
+    for guild_id in guild_ids:
+        rows += [
+            ("ticket", guild_id, ticket.serialize_value([
+                ticket.TicketButton(snowflake(), "🎫", "質問", "お問い合わせ"), ticket.TicketButton(snowflake(), None, "報告", None)
+            ])),
+            ("panel_title", guild_id, f"サポート {guild_id}"),
+            ("staff_role", guild_id, snowflake()),
+            ("dm_message", guild_id, "お問い合わせありがとうございました。"),
+        ]
+    return guild_ids, rows
+
+async def run_command(fake, started, guild_id, name, options=(), until="ack", timeout=120.0):
+    # コマンドを1回実行し、until の計測点まで待つ
+    token, payload = fake.command(guild_id, snowflake(), name, options)
+    started[token] = time.perf_counter()
+    fake.dispatch(payload)
+    await wait_marks(fake, [(until, token)], timeout)
+    return token
+
+def report_interactions(fake, name, started, kinds):
+    first = min(started.values(), default=0)
+    for kind, label in kinds:
+        report(f"{name} {label}", latencies(fake, kind, started), elapsed_until(fake, kind, started, first))
+
+async def save_load(ticket, fake, guilds, count, rounds, restores, timeout):
+    # count サーバー分の設定を書き込み、保存・起動時の読み込み・1サーバー分の復元を測る。
+    # 保存と復元は利用者と同じくinteractionから実行し、最初の応答と完了までの時間を見る
+    guild_ids, rows = fill_settings(ticket, count)
+    ticket.load_settings_from_rows(rows)
+    print(f"設定の保存と読み込み ({count + len(guilds)} サーバー)")
+
+    started = time.perf_counter()
+    await ticket.run_io(ticket.write_rows, rows)
+    report_once("SQLiteへ書き込み", time.perf_counter() - started, len(rows))
+
+    started = {}
+    for _ in range(rounds):
+        await run_command(fake, started, guilds[0].id, "ticket_save", until="followup", timeout=timeout)
+    report_interactions(fake, "/ticket_save", started, [("ack", "応答 (defer)"), ("followup", "保存完了")])
+
+    ticket.guild_configs.clear()
+    started = time.perf_counter()
+    loaded = await ticket.run_io(ticket.settings_store.load_all)
+    ticket.load_settings_from_rows(loaded)
+    report_once("起動時の読み込み", time.perf_counter() - started, len(loaded))
+
+    # /ticket_road で一覧を出し、先頭の保存ファイルを選んでロードする
+    listed, selected = {}, {}
+    for _ in range(restores):
+        guild = random.choice(guilds)
+        token = await run_command(fake, listed, guild.id, "ticket_road", until="followup", timeout=timeout)
+        message = fake.responses.get(token)
+        if not message or not message["components"]:
+            continue
+        select = message["components"][0]["components"][0]
+        token, payload = fake.interaction(
+            guild.id, snowflake(), {"component_type": 3, "custom_id": select["custom_id"], "values": [select["options"][0]["value"]]}, 1, message
+        )
+        selected[token] = time.perf_counter()
+        fake.dispatch(payload)
+        await wait_marks(fake, [("followup", token)], timeout)
+    report_interactions(fake, "/ticket_road", listed, [("ack", "応答 (defer)"), ("followup", "一覧の表示")])
+    report_interactions(fake, "/ticket_road 選択", selected, [("ack", "応答 (defer)"), ("followup", "ロード完了")])
+
+    if ticket.JOURNAL_MODE:
+        timestamp = ticket.save_catalog.entries[-1]["timestamp"]
+        started = {}
+        for _ in range(restores):
+            await run_command(
+                fake, started, random.choice(guilds).id, "ticket_restore", [("timestamp", 3, timestamp)], until="followup", timeout=timeout
+            )
+        report_interactions(fake, "/ticket_restore", started, [("ack", "応答 (defer)"), ("followup", "復元完了")])
+
+async def main(args):
+    import ticket
+
+    ticket.rest_scheduler.budgets = {kind: (capacity * args.budget_scale, per) for kind, (capacity, per) in ticket.REST_BUDGETS.items()}
+    fake = FakeDiscord(args.latency, args.jitter, args.rate_limit, args.retry_after)
+    await fake.start()
+    payloads = [fake.guild_payload(snowflake(), args.members) for _ in range(args.guilds)]
+    started = time.perf_counter()
+    await fake.connect(ticket.bot, payloads)
+    # ticket.py の on_ready（コマンドの同期とチケットの登録簿の再構築）が終わるまでを起動時間とする
+    while not ticket.refill_warm_pools.is_running():
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    guilds = [ticket.bot.get_guild(int(payload["id"])) for payload in payloads]
+    print(f"起動 ({args.guilds} サーバー x {args.members} メンバー{' / 省メモリモード' if ticket.LOW_MEMORY_MODE else ''})")
+    print(f"  readyまで {elapsed * 1000:.1f} ms  キャッシュ済みメンバー {sum(len(guild.members) for guild in guilds)} 人  ピークRSS {peak_rss()}")
+    for guild in guilds:
+        ticket.get_config(guild.id).ticket = [ticket.TicketButton(guild.categories[0].id, None, "質問", "お問い合わせ", pool_size=args.pool_size)]
+    print(f"遅延 {args.latency * 1000:.0f}+{args.jitter * 1000:.0f} ms / 429注入 {args.rate_limit:.0%} / 予算 x{args.budget_scale}")
+
+    try:
+        if args.scenario in ("panel", "all"):
+            if args.pool_size:
+                # 計測前にウォームプールを1回で満たしておく
+                ticket.WARM_POOL_REFILL_BUDGET = args.guilds * args.pool_size
+                await ticket.refill_warm_pools()
+            await panel_burst(ticket, fake, guilds, args.per_guild, args.timeout)
+            print(f"  ピークRSS {peak_rss()}")
+        if args.scenario in ("close", "all"):
+            if not ticket.open_tickets:
+                await panel_burst(ticket, fake, guilds, args.per_guild, args.timeout)
+            await mass_close(ticket, fake, args.timeout)
+            print(f"  ピークRSS {peak_rss()}")
+        if args.scenario in ("save", "all"):
+            await save_load(ticket, fake, guilds, args.save_guilds, args.save_rounds, args.restores, args.timeout)
+            print(f"  ピークRSS {peak_rss()}")
+        print(f"429応答 {fake.rate_limited} 回 / RESTリクエスト {sum(fake.calls.values())} 回")
+    finally:
+        await ticket.bot.close()
+        await fake.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ticket.py のローカル負荷試験")
+    parser.add_argument("--scenario", choices=("startup", "panel", "close", "save", "all"), default="all")
+    parser.add_argument("--guilds", type=int, default=100, help="パネル・クローズのシナリオで使うサーバー数")
+    parser.add_argument("--members", type=int, default=0, help="1サーバーあたりのメンバー数（起動時に取得される）")
+    parser.add_argument("--low-memory", action="store_true", help="ticket.py を省メモリモードで動かす（ticket.py がこの引数を読む）")
+    parser.add_argument("--per-guild", type=int, default=5, help="1サーバーあたりのチケット作成数")
+    parser.add_argument("--pool-size", type=int, default=0, help="ウォームプールの大きさ")
+    parser.add_argument("--save-guilds", type=int, default=10000, help="保存・読み込みのシナリオで使うサーバー数")
+    parser.add_argument("--save-rounds", type=int, default=5, help="/ticket_save の実行回数")
+    parser.add_argument("--restores", type=int, default=200, help="1サーバー分の復元を行う回数")
+    parser.add_argument("--latency", type=float, default=0.0, help="RESTの応答遅延（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="応答遅延に加える最大ゆらぎ（秒）")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="429を返す割合 (0〜1)")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="429で返すretry_after（秒）")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="ticket.py のREST予算を何倍にするか")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1シナリオの完了を待つ最大秒数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # 保存ファイルやSQLiteは一時ディレクトリに作り、作業ツリーを汚さない
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="ticket-bench-"))
+    asyncio.run(main(args))
@@ -14,6 +14,36 @@ bot = commands.Bot(command_prefix="/", intents=intents)
 # チケット設定（ギルドごとの設定を保存）
 settings = {key: {} for key in ["ticket", "panel_title", "panel_description", "panel_url", "staff_role", "developed_info", "dm_message", "embed_title", "embed_description", "embed_color", "link", "panel_image", "panel_color", "top_right_image", "developer_text", "developer_image", "open_image", "close_image", "allowed_roles"]}
 
+# オープン中のチケット: (guild_id, user_id) -> channel_id と、その逆引き channel_id -> (guild_id, user_id)
+open_tickets, ticket_owners = {}, {}
+
+def register_ticket(guild_id, user_id, channel_id):
+    open_tickets[(guild_id, user_id)], ticket_owners[channel_id] = channel_id, (guild_id, user_id)
+
+def unregister_ticket(channel_id):
+    owner = ticket_owners.pop(channel_id, None)
+    if owner and open_tickets.get(owner) == channel_id:
+        del open_tickets[owner]
+    return owner
+
+def find_open_ticket(guild, user_id):
+    channel_id = open_tickets.get((guild.id, user_id))
+    channel = guild.get_channel(channel_id) if channel_id is not None else None
+    if channel_id is not None and channel is None:
+        unregister_ticket(channel_id)
+    return channel
+
+def rebuild_ticket_registry():
+    open_tickets.clear()
+    ticket_owners.clear()
+    for guild in bot.guilds:
+        for channel in guild.text_channels:
+            if channel.name.startswith(("ticket-", "📌ticket-")):
+                for target, overwrite in channel.overwrites.items():
+                    if (isinstance(target, discord.Member) or (isinstance(target, discord.Object) and target.type is not discord.Role)) and target.id != bot.user.id and overwrite.send_messages:
+                        register_ticket(guild.id, target.id, channel.id)
+                        break
+
 def create_ticket_embed(title="チケットサポート", description="以下のボタンを押してチケットを開いてください。", **kwargs):
     embed = discord.Embed(title=title, description=description, color=kwargs.get("color", discord.Color.blue()))
     for key, value in kwargs.items():
@@ -48,7 +78,7 @@ async def create_ticket(interaction: discord.Interaction, category_id: int, answ
         await interaction.response.send_message("カテゴリーが見つかりません！", ephemeral=True)
         return
 
-    if discord.utils.get(guild.text_channels, name=f"ticket-{interaction.user.name.lower()}"):
+    if find_open_ticket(guild, interaction.user.id):
         await interaction.response.send_message("既にチケットが開かれています！", ephemeral=True)
         return
 
@@ -61,13 +91,14 @@ async def create_ticket(interaction: discord.Interaction, category_id: int, answ
             overwrites[role] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
 
     ticket_channel = await guild.create_text_channel(name=f"ticket-{interaction.user.name}", category=category, overwrites=overwrites)
+    register_ticket(guild.id, interaction.user.id, ticket_channel.id)
     embed_title = settings.get("embed_title", {}).get(guild.id, "チケット")
     description = settings.get("embed_description", {}).get(guild.id, "サポートが必要ですか？")
     color = settings.get("embed_color", {}).get(guild.id, discord.Color.blue())
     image_file = settings["open_image"].get(guild.id)
 
     if answers:
-        description += "\n\n" + "\n.join([f"{key}: {value}" for key, value in answers.items()])
+        description += "\n\n" + "\n".join([f"{key}: {value}" for key, value in answers.items()])
 
     await interaction.response.send_message(embed=discord.Embed(title="🎫 チケットが作成されました。", description="下のボタンをクリックしてアクセスしてください。", color=color).set_author(name=interaction.user.name, icon_url=interaction.user.avatar.url if interaction.user.avatar else None), view=VisitTicketView(ticket_channel), ephemeral=True)
 
@@ -91,6 +122,9 @@ class CloseTicketView(discord.ui.View):
         if staff_role not in interaction.user.roles:
             await interaction.response.send_message("この操作を行う権限がありません。", ephemeral=True)
             return
+        if interaction.channel.id not in ticket_owners:
+            await interaction.response.send_message("このチャンネルはチケットではありません。", ephemeral=True)
+            return
         await interaction.channel.edit(name=f"📌{interaction.channel.name}")
         await interaction.response.send_message("チケットがピンされました。", ephemeral=True)
 
@@ -113,6 +147,7 @@ class ConfirmCloseView(discord.ui.View):
             if ticket_link:
                 view.add_item(discord.ui.Button(label="チケットをもう一度作成する", style=discord.ButtonStyle.primary, url=ticket_link))
             await interaction.user.send(embed=embed, view=view, files=files)
+        # 登録簿からの削除は on_guild_channel_delete に任せる（削除に失敗したチケットは登録されたまま残る）
         await interaction.channel.delete()
 
     @discord.ui.button(label="いいえ", style=discord.ButtonStyle.secondary)
@@ -240,8 +275,13 @@ async def ticket_load_command(interaction: discord.Interaction):
 @bot.event
 async def on_ready():
     await bot.tree.sync()
+    rebuild_ticket_registry()
     print(f"Logged in as {bot.user}")
 
+@bot.event
+async def on_guild_channel_delete(channel):
+    unregister_ticket(channel.id)
+
 @bot.event
 async def on_message(message):
     if message.author.bot:
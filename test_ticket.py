@@ -0,0 +1,266 @@
+import asyncio
+import heapq
+import time
+import unittest
+from unittest import mock
+
+import ticket
+
+
+class FakeGuild:
+    def __init__(self, unavailable=False):
+        self.unavailable = unavailable
+
+
+class FakeBot:
+    def __init__(self, channels=(), guilds=()):
+        self.channels = {channel.id: channel for channel in channels}
+        self.guilds = list(guilds)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class IdleSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.patches = [
+            mock.patch.object(ticket, "idle_tickets", {}),
+            mock.patch.object(ticket, "idle_heap", []),
+            mock.patch.object(ticket, "idle_dirty", set()),
+            mock.patch.object(ticket, "idle_wakeup", asyncio.Event()),
+            mock.patch.object(ticket, "guild_cache_ready", asyncio.Event()),
+            mock.patch.object(ticket, "send_idle_warning", mock.AsyncMock()),
+            mock.patch.object(ticket, "enqueue_close", mock.Mock(return_value=True)),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.scheduler = None
+
+    async def asyncTearDown(self):
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+            try:
+                await self.scheduler
+            except asyncio.CancelledError:
+                pass
+        for patch in self.patches:
+            patch.stop()
+
+    def start_scheduler(self, bot):
+        patch = mock.patch.object(ticket, "bot", bot)
+        patch.start()
+        self.patches.append(patch)
+        self.scheduler = asyncio.create_task(ticket.idle_scheduler())
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_restart_keeps_tickets_until_cache_is_ready(self):
+        # 再起動前に期限を過ぎていたチケット。READY前はキャッシュが空なので見つからない
+        past = time.time() - 7200
+        ticket.load_idle([(1, past, 3600, 0), (2, past, 3600, 1)])
+        bot = FakeBot()
+        self.start_scheduler(bot)
+        await self.settle()
+        self.assertEqual(set(ticket.idle_tickets), {1, 2})
+        self.assertFalse(ticket.idle_dirty)
+        ticket.send_idle_warning.assert_not_called()
+
+        # READYでキャッシュが揃ったら、警告前のものは警告し、警告済みのものは閉じる
+        bot.channels = {1: FakeChannel(1), 2: FakeChannel(2)}
+        ticket.guild_cache_ready.set()
+        await self.settle()
+        self.assertEqual(ticket.send_idle_warning.call_args[0][0].id, 1)
+        self.assertTrue(ticket.idle_tickets[1][2])
+        self.assertEqual(ticket.enqueue_close.call_args[0][0].id, 2)
+        self.assertIn(2, ticket.idle_tickets)
+
+    async def test_missing_channel_is_untracked_once_cache_is_ready(self):
+        ticket.load_idle([(1, time.time() - 7200, 3600, 1)])
+        ticket.guild_cache_ready.set()
+        self.start_scheduler(FakeBot(guilds=[FakeGuild()]))
+        await self.settle()
+        self.assertNotIn(1, ticket.idle_tickets)
+        self.assertIn(1, ticket.idle_dirty)
+
+    async def test_missing_channel_is_retried_while_a_guild_is_unavailable(self):
+        ticket.load_idle([(1, time.time() - 7200, 3600, 1)])
+        ticket.guild_cache_ready.set()
+        self.start_scheduler(FakeBot(guilds=[FakeGuild(), FakeGuild(unavailable=True)]))
+        await self.settle()
+        self.assertIn(1, ticket.idle_tickets)
+        due, channel_id = ticket.idle_heap[0]
+        self.assertEqual(channel_id, 1)
+        self.assertGreater(due, time.time() + ticket.IDLE_RETRY_SECONDS - 60)
+
+    async def test_stale_heap_entry_is_pushed_back(self):
+        # ヒープに積んだ後に発言があったので、取り出した時に実際の予定で積み直す
+        ticket.track_idle(1, 3600)
+        ticket.idle_tickets[1][0] = time.time()
+        heapq.heapreplace(ticket.idle_heap, (time.time() - 1, 1))
+        ticket.guild_cache_ready.set()
+        self.start_scheduler(FakeBot(channels=[FakeChannel(1)]))
+        await self.settle()
+        ticket.send_idle_warning.assert_not_called()
+        self.assertEqual(ticket.idle_heap, [(ticket.idle_due(ticket.idle_tickets[1]), 1)])
+        self.assertFalse(ticket.idle_tickets[1][2])
+
+
+class ReplaceGuildSettingsTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(ticket, "guild_configs", {})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_fields_missing_from_the_snapshot_go_back_to_defaults(self):
+        # 復元する時点で未設定だったフィールドは、現在の値を残さず既定値に戻す
+        config = ticket.get_config(1)
+        config.panel_title = "現在のタイトル"
+        config.panel_url = "https://example.com"
+        config.url_channels = frozenset({10, 11})
+        rows = ticket.replace_guild_settings(1, {"panel_title": "当時のタイトル"})
+        self.assertEqual(config.panel_title, "当時のタイトル")
+        self.assertIsNone(config.panel_url)
+        self.assertEqual(config.url_channels, frozenset())
+        self.assertEqual({field for field, _, _ in rows}, {"panel_title", "panel_url", "url_channels"})
+        self.assertEqual(ticket.replace_guild_settings(1, {"panel_title": "当時のタイトル"}), [])
+
+    def test_unknown_fields_are_ignored(self):
+        rows = ticket.replace_guild_settings(1, {"no_such_field": 1})
+        self.assertEqual(rows, [])
+        self.assertEqual(list(ticket.get_config(1).fields()), [])
+
+
+class FakeTextChannel(ticket.discord.TextChannel):
+    # isinstance で TextChannel として扱われ、overwrites_for だけを持つチャンネル
+    def __init__(self, channel_id, category_id, user_id):
+        self.id = channel_id
+        self.category_id = category_id
+        self.user_id = user_id
+
+    def overwrites_for(self, target):
+        return ticket.discord.PermissionOverwrite(send_messages=True if target.id == self.user_id else None)
+
+
+class FakeCategory:
+    def __init__(self, category_id):
+        self.id = category_id
+        self.text_channels = []
+
+
+class FakeCreateGuild:
+    # 1回目の作成はDiscord側で成功したのに応答がタイムアウトする
+    def __init__(self, category, error):
+        self.id = 1
+        self.category = category
+        self.error = error
+        self.created = []
+
+    async def create_text_channel(self, name, category, overwrites):
+        channel = FakeTextChannel(100 + len(self.created), category.id, 7)
+        self.created.append(channel)
+        if len(self.created) == 1:
+            raise self.error
+        return channel
+
+    async def fetch_channels(self):
+        return list(self.created)
+
+
+class CreateTicketChannelTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        for patch in (
+            mock.patch.object(ticket, "rest_scheduler", ticket.RestScheduler(ticket.REST_BUDGETS, ticket.REST_GUILD_CONCURRENCY)),
+            mock.patch.object(ticket, "ticket_owners", {}),
+            mock.patch.object(ticket, "warm_pools", {}),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.category = FakeCategory(10)
+
+    async def test_timed_out_creation_reuses_the_created_channel(self):
+        guild = FakeCreateGuild(self.category, asyncio.TimeoutError())
+        with self.assertLogs("ticket", "WARNING"):
+            channel = await ticket.create_ticket_channel(guild, self.category, "ticket-user", {}, 7)
+        self.assertIs(channel, guild.created[0])
+        self.assertEqual(len(guild.created), 1)
+
+    async def test_channel_from_the_cache_is_reused_without_fetching(self):
+        guild = FakeCreateGuild(self.category, asyncio.TimeoutError())
+        guild.fetch_channels = mock.AsyncMock(side_effect=AssertionError("fetched"))
+        cached = FakeTextChannel(50, self.category.id, 7)
+        self.category.text_channels.append(cached)
+        with self.assertLogs("ticket", "WARNING"):
+            channel = await ticket.create_ticket_channel(guild, self.category, "ticket-user", {}, 7)
+        self.assertIs(channel, cached)
+
+    async def test_registered_or_other_users_channels_are_not_reused(self):
+        guild = FakeCreateGuild(self.category, asyncio.TimeoutError())
+        guild.fetch_channels = mock.AsyncMock(return_value=[
+            FakeTextChannel(60, self.category.id, 7), FakeTextChannel(61, self.category.id, 8), FakeTextChannel(62, 99, 7)
+        ])
+        ticket.ticket_owners[60] = (1, 7)
+        with self.assertRaises(asyncio.TimeoutError):
+            await ticket.create_ticket_channel(guild, self.category, "ticket-user", {}, 7)
+
+    async def test_rate_limited_creation_is_left_to_the_retry(self):
+        response = mock.Mock(status=429, reason="Too Many Requests")
+        guild = FakeCreateGuild(self.category, ticket.discord.HTTPException(response, "rate limited"))
+        guild.fetch_channels = mock.AsyncMock(side_effect=AssertionError("fetched"))
+        with self.assertRaises(ticket.discord.HTTPException):
+            await ticket.create_ticket_channel(guild, self.category, "ticket-user", {}, 7)
+
+
+class RestSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.scheduler = ticket.RestScheduler(ticket.REST_BUDGETS, ticket.REST_GUILD_CONCURRENCY)
+        self.calls = []
+
+    def op(self, name):
+        async def run():
+            self.calls.append(name)
+            return name
+        return run
+
+    async def test_delete_drops_pending_edits_and_merges_with_a_pending_delete(self):
+        edit = self.scheduler.submit(1, "edit", ticket.PRIORITY_UPDATE, self.op("edit"), channel_id=5)
+        first = self.scheduler.submit(1, "delete", ticket.PRIORITY_CLEANUP, self.op("delete"), channel_id=5)
+        second = self.scheduler.submit(1, "delete", ticket.PRIORITY_CLEANUP, self.op("delete again"), channel_id=5)
+        self.assertIsNone(await edit)
+        self.assertEqual(await first, "delete")
+        self.assertEqual(await second, "delete")
+        self.assertEqual(self.calls, ["delete"])
+
+    async def test_edits_of_other_channels_are_kept(self):
+        edit = self.scheduler.submit(1, "edit", ticket.PRIORITY_UPDATE, self.op("edit 6"), channel_id=6)
+        delete = self.scheduler.submit(1, "delete", ticket.PRIORITY_CLEANUP, self.op("delete 5"), channel_id=5)
+        self.assertEqual(await asyncio.gather(edit, delete), ["edit 6", "delete 5"])
+
+    async def test_runs_by_priority_across_buckets(self):
+        futures = [
+            self.scheduler.submit(1, "delete", ticket.PRIORITY_CLEANUP, self.op("cleanup"), channel_id=5),
+            self.scheduler.submit(1, "send", ticket.PRIORITY_UPDATE, self.op("update"), channel_id=6),
+            self.scheduler.submit(1, "create", ticket.PRIORITY_CREATE, self.op("create")),
+        ]
+        await asyncio.gather(*futures)
+        self.assertEqual(self.calls, ["create", "update", "cleanup"])
+
+    async def test_guild_state_is_released_after_draining(self):
+        await self.scheduler.submit(1, "send", ticket.PRIORITY_UPDATE, self.op("send"), channel_id=5)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual(self.scheduler.depth(), 0)
+        for state in (self.scheduler.queues, self.scheduler.wakeups, self.scheduler.workers, self.scheduler.in_flight, self.scheduler.deletes):
+            self.assertEqual(state, {})
+        self.scheduler.forget_channel(5)
+        self.assertNotIn(("send", 5), self.scheduler.buckets)
+
+
+if __name__ == "__main__":
+    unittest.main()
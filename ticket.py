@@ -1,14 +1,409 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from aiohttp import web
+import aiohttp
+import array
+import asyncio
+import bisect
+import contextvars
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import logging
+import multiprocessing
 import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+try:
+    # 画像の縮小・再圧縮に使う（任意）。無ければアップロードされた画像をそのまま使う
+    from PIL import Image, ImageOps, ImageSequence
+except ImportError:
+    Image = None
+
+log = logging.getLogger("ticket")
 
-# Ensure the save directory exists
 SAVE_DIR = "ticket_saves"
-if not os.path.exists(SAVE_DIR):
-    os.makedirs(SAVE_DIR)
+SETTINGS_DB = os.path.join(SAVE_DIR, "settings.db")
+# ジャーナルモード: 設定変更を追記ログに記録し、定期的にスナップショットへ畳み込む
+JOURNAL_MODE = True
+JOURNAL_COMPACT_MINUTES = 10
+SNAPSHOT_RETENTION = 20
+# /ticket_road の1ページに表示する保存ファイル数（Discordのセレクトメニューの上限）
+SAVES_PER_PAGE = 25
+# チケット作成の各段階で、一時的なエラー（5xx・通信エラー）を再試行する回数
+TICKET_STAGE_RETRIES = 3
+# 事前作成チャンネル（ウォームプール）の補充間隔と、1回の補充で作成・削除するチャンネル数の上限
+WARM_POOL_REFILL_SECONDS = 30
+WARM_POOL_REFILL_BUDGET = 5
+WARM_POOL_NAME = "warm-ticket"
+# REST操作の種類ごとの予算（回数, 秒）。create/delete はギルド単位、edit/send はチャンネル単位
+# チャンネル名の変更はDiscord側で1チャンネル10分に2回までに制限されている
+REST_BUDGETS = {
+    "create": (5, 5.0),
+    "delete": (5, 5.0),
+    "edit": (2, 600.0),
+    "send": (5, 5.0),
+}
+# 1ギルドで同時に実行するREST操作の数
+REST_GUILD_CONCURRENCY = 4
+# 優先度（小さいほど先）: 利用者を待たせる操作 > ピンなどの変更 > 後片付け
+PRIORITY_CREATE = 0
+PRIORITY_UPDATE = 1
+PRIORITY_CLEANUP = 2
+# チケットを閉じる処理（DM送信）の並列数と、まとめて削除するチャンネル数の上限
+CLOSE_WORKERS = 4
+CLOSE_DELETE_BATCH = 10
+# 送れなかった閉鎖DMの記録先
+DEAD_LETTER_PATH = os.path.join(SAVE_DIR, "dead_letters.jsonl")
+# 閉じる前にチャンネルの履歴をgzip圧縮のJSONLで保存する
+TRANSCRIPT_MODE = True
+TRANSCRIPT_DIR = os.path.join(SAVE_DIR, "transcripts")
+TRANSCRIPT_INDEX = os.path.join(TRANSCRIPT_DIR, "index.jsonl")
+# 同時に保存するチケット数と、1回にまとめて書き込むメッセージ数（履歴APIの1ページ分）
+TRANSCRIPT_CONCURRENCY = 4
+TRANSCRIPT_PAGE = 100
+# トランスクリプトの全文検索索引
+SEARCH_DB = os.path.join(SAVE_DIR, "search.db")
+SEARCH_BATCH = 500
+SEARCH_RESULTS_PER_PAGE = 10
+# チケットの統計（日ごとの集計）。メモリには /ticket_stats の最長期間分だけ持つ
+STATS_DB = os.path.join(SAVE_DIR, "stats.db")
+STATS_DAYS = 30
+# 作成から閉じるまでの時間のヒストグラムの境界（秒）: 1分〜30日
+CLOSE_TIME_BOUNDS = (
+    60, 300, 900, 1800, 3600, 7200, 14400, 28800, 43200,
+    86400, 172800, 259200, 604800, 1209600, 2592000,
+)
+# 放置されたチケットの自動クローズ。閉じる前に警告する時間（タイムアウトの半分を超えない）
+IDLE_DB = os.path.join(SAVE_DIR, "idle.db")
+IDLE_WARNING_SECONDS = 3600
+# 最終発言時刻をまとめて保存する間隔
+IDLE_FLUSH_SECONDS = 60
+# 利用できないサーバーがある間に見つからなかったチケットを確かめ直すまでの時間
+IDLE_RETRY_SECONDS = 600
+# 設定画像のローカルキャッシュ（sha256で管理し、合計サイズを超えたら古いものから消す）
+IMAGE_CACHE_DIR = os.path.join(SAVE_DIR, "images")
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+IMAGE_FIELDS = ("panel_image", "top_right_image", "developer_image", "open_image", "close_image")
+# embedに表示される大きさ（高解像度ディスプレイ向けに余裕を持たせる）まで縮小する
+IMAGE_MAX_SIZE = (800, 800)
+# 添付画像のURL返信。同じチャンネルの添付はこの秒数だけまとめてから1通で返し、
+# 1チャンネルあたり URL_REPLY_INTERVAL 秒に1通までにする
+URL_REPLY_WINDOW = 1.0
+URL_REPLY_INTERVAL = 5.0
+URL_REPLY_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")
+# Prometheus形式の計測値を返すローカルHTTPエンドポイント（METRICS_PORT が0なら起動しない）
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+# ギルドごとにラベルを分けるか（サーバー数が多いと系列が増えるので、その場合は False にする）
+METRICS_PER_GUILD = True
+# 所要時間のヒストグラムの境界（秒）
+LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# イベントループの遅れを測る間隔と、止まっているとみなしてスタックを記録する時間（秒、0で監視しない）
+LOOP_LAG_INTERVAL = 0.1
+SLOW_CALLBACK_SECONDS = 0.5
+# 記録するスタックの深さ（止まっている処理に近い側から）
+SLOW_CALLBACK_STACK_DEPTH = 30
+# cProfileのスナップショットを書き出す間隔（分、0で取らない）と保持数
+PROFILE_DIR = os.path.join(SAVE_DIR, "profiles")
+PROFILE_MINUTES = 0
+PROFILE_RETENTION = 24
+
+# 設定の保存・読み込みはイベントループを止めないよう専用スレッドで行う。
+# ワーカーを1つにすることで書き込み順序が保たれ、SQLite接続も同じスレッドだけが使う。
+io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ticket-io")
+
+async def run_io(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+# 画像の再圧縮はCPUを使うので別プロセスで行う。
+# 複数のスレッドが動いているプロセスをforkすると子がロックを握ったまま止まりうるので、spawnで起動する
+image_executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn")) if Image is not None else None
+
+# トランスクリプトの書き込みは設定の保存を待たせないよう別スレッドで行う
+transcript_executor = ThreadPoolExecutor(max_workers=TRANSCRIPT_CONCURRENCY, thread_name_prefix="ticket-transcript")
+
+# 検索索引への書き込みは専用スレッドで行う（書き込み用のSQLite接続もこのスレッドだけが使う）
+search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ticket-search")
+# 検索は読み取り専用の接続を持つ別スレッドで行い、大きなトランスクリプトの索引づけを待たない
+query_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ticket-query")
+
+def _log_io_error(future):
+    if future.exception() is not None:
+        log.error("設定の保存に失敗しました", exc_info=future.exception())
+
+def submit_io(func, *args):
+    # 結果を待たない書き込み用。失敗はログに残す
+    future = io_executor.submit(func, *args)
+    future.add_done_callback(_log_io_error)
+    return future
+
+def write_bytes_atomic(path, payload):
+    # 一時ファイルに書き切ってから置き換えるので、途中で落ちても壊れたファイルが残らない
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def write_json_atomic(path, data, indent=None):
+    payload = json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+    write_bytes_atomic(path, payload)
+    return payload
+
+def append_jsonl(path, record):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class Metrics:
+    # Prometheusのテキスト形式で書き出す計測値。値の更新はイベントループ上でのみ行う。
+    # ヒストグラムはラベルの組ごとに [区間ごとの件数..., 合計秒] を持ち、累積は書き出す時に計算する
+    def __init__(self):
+        self.families = {}  # name -> (種類, 説明, ラベル名)
+        self.values = {}  # name -> {ラベル値のタプル: 値}
+        self.gauges = {}  # name -> 現在値を返す関数
+
+    def histogram(self, name, help, labels):
+        self.families[name] = ("histogram", help, labels)
+        self.values[name] = {}
+
+    def counter(self, name, help, labels):
+        self.families[name] = ("counter", help, labels)
+        self.values[name] = {}
+
+    def gauge(self, name, help, func):
+        self.families[name] = ("gauge", help, ())
+        self.gauges[name] = func
+
+    def observe(self, name, labels, seconds):
+        series = self.values[name].get(labels)
+        if series is None:
+            series = self.values[name][labels] = [0] * (len(LATENCY_BOUNDS) + 1) + [0.0]
+        series[bisect.bisect_left(LATENCY_BOUNDS, seconds)] += 1
+        series[-1] += seconds
+
+    def inc(self, name, labels):
+        values = self.values[name]
+        values[labels] = values.get(labels, 0) + 1
+
+    def render(self):
+        def braces(pairs):
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        for name, (kind, help, label_names) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                lines.append(f"{name} {self.gauges[name]()}")
+                continue
+            for labels, value in self.values[name].items():
+                pairs = [f'{key}="{label}"' for key, label in zip(label_names, labels)]
+                if kind == "counter":
+                    lines.append(f"{name}{braces(pairs)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BOUNDS + ("+Inf",), value):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{braces(pairs + [le])} {cumulative}")
+                lines.append(f"{name}_sum{braces(pairs)} {value[-1]}")
+                lines.append(f"{name}_count{braces(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("ticket_handler_seconds", "スラッシュコマンド・コンポーネントの処理時間", ("handler", "guild"))
+metrics.counter("ticket_handler_errors_total", "例外で終わったスラッシュコマンド・コンポーネントの数", ("handler", "guild"))
+metrics.histogram("ticket_rest_seconds", "REST呼び出し1回の所要時間", ("handler", "guild", "route"))
+metrics.counter("ticket_rest_429_total", "429（レート制限）で返されたREST呼び出しの数", ("handler", "guild", "route"))
+metrics.counter("ticket_rest_errors_total", "429以外のエラーで終わったREST呼び出しの数", ("handler", "guild", "route", "status"))
+metrics.histogram("ticket_rest_wait_seconds", "RestSchedulerで予算の回復を待った時間", ("kind", "guild"))
+metrics.histogram("ticket_stage_seconds", "チケット処理の段階ごとの所要時間（再試行込み）", ("stage",))
+metrics.histogram("ticket_loop_lag_seconds", "イベントループの遅れ", ())
+metrics.counter("ticket_slow_callbacks_total", "イベントループを SLOW_CALLBACK_SECONDS 以上止めた処理の数", ("handler",))
+metrics.gauge("ticket_rest_queue_depth", "RestSchedulerで実行を待っている操作の数", lambda: rest_scheduler.depth())
+metrics.gauge("ticket_close_queue_depth", "閉じる処理を待っているチケットの数", lambda: close_queue.qsize())
+metrics.gauge("ticket_open_tickets", "オープン中のチケットの数", lambda: len(open_tickets))
+
+# 実行中のハンドラー名とギルド。ハンドラーから始まったバックグラウンド処理やREST呼び出しにも引き継がれる
+handler_labels = contextvars.ContextVar("handler_labels", default=("background", "0"))
+# 実行中のハンドラー: Task -> (handler, guild)。ループが止まった時に監視スレッドが何の処理かを調べる
+running_handlers = {}
+
+def metric_guild(guild_id):
+    if not METRICS_PER_GUILD:
+        return "all"
+    return str(guild_id or 0)
+
+def instrumented(name):
+    # スラッシュコマンドとコンポーネントのコールバックに付け、所要時間と例外を記録する
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            interaction = next(arg for arg in args if isinstance(arg, discord.Interaction))
+            labels = (name, metric_guild(interaction.guild_id))
+            token = handler_labels.set(labels)
+            task = asyncio.current_task()
+            running_handlers[task] = labels
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.inc("ticket_handler_errors_total", labels)
+                raise
+            finally:
+                metrics.observe("ticket_handler_seconds", labels, time.perf_counter() - start)
+                running_handlers.pop(task, None)
+                handler_labels.reset(token)
+        return wrapper
+    return decorator
+
+ROUTE_TOKEN = re.compile(r"/(interactions|webhooks)/([0-9]+)/[^/]+")
+ROUTE_ID = re.compile(r"/[0-9]{15,}")
+
+def rest_route(method, path):
+    # IDとトークンを伏せて、ルートごとに集計できる形にする
+    path = ROUTE_TOKEN.sub(r"/\1/{id}/{token}", path.split("/api/v10", 1)[-1])
+    return method + " " + ROUTE_ID.sub("/{id}", path)
+
+async def on_rest_start(session, context, params):
+    context.start = time.perf_counter()
+
+async def on_rest_end(session, context, params):
+    handler, guild = handler_labels.get()
+    route = rest_route(params.method, params.url.path)
+    metrics.observe("ticket_rest_seconds", (handler, guild, route), time.perf_counter() - context.start)
+    status = params.response.status
+    if status == 429:
+        metrics.inc("ticket_rest_429_total", (handler, guild, route))
+    elif status >= 400:
+        metrics.inc("ticket_rest_errors_total", (handler, guild, route, str(status)))
+
+async def on_rest_exception(session, context, params):
+    handler, guild = handler_labels.get()
+    route = rest_route(params.method, params.url.path)
+    metrics.inc("ticket_rest_errors_total", (handler, guild, route, type(params.exception).__name__))
+
+# discord.py のHTTPセッション（Webhook・インタラクション応答を含む）の全リクエストを計測する
+rest_trace = aiohttp.TraceConfig()
+rest_trace.on_request_start.append(on_rest_start)
+rest_trace.on_request_end.append(on_rest_end)
+rest_trace.on_request_exception.append(on_rest_exception)
+
+async def metrics_handler(request):
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log.info("計測値を http://%s:%d/metrics で公開しています", METRICS_HOST, METRICS_PORT)
+
+class LoopWatchdog:
+    # イベントループを止めている処理を見つける監視スレッド。
+    # ループ側は monitor_loop_lag から時刻を書き込むだけで、止まっている間のスタックはこのスレッドが取る
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat = time.monotonic()
+
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        threading.Thread(target=self.watch, name="ticket-watchdog", daemon=True).start()
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+
+    def watch(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+            # 同じ停止は1回だけ記録する
+            if stalled >= self.threshold and heartbeat != reported:
+                reported = heartbeat
+                self.report(stalled)
+
+    def report(self, stalled):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        task = asyncio.current_task(self.loop)
+        if task is None:
+            handler, guild = "callback", "0"
+        elif task in running_handlers:
+            handler, guild = running_handlers[task]
+        else:
+            handler, guild = task.get_name(), "0"
+            coro = task.get_coro()
+            if coro is not None:
+                handler = f"{handler} ({getattr(coro, '__qualname__', coro)})"
+        stack = "".join(traceback.format_stack(frame, SLOW_CALLBACK_STACK_DEPTH)) if frame is not None else ""
+        log.warning("イベントループが %.0fms 止まっています: %s (guild %s)\n%s", stalled * 1000, handler, guild, stack)
+        self.loop.call_soon_threadsafe(metrics.inc, "ticket_slow_callbacks_total", (handler,))
+
+watchdog = LoopWatchdog(SLOW_CALLBACK_SECONDS)
+
+async def monitor_loop_lag():
+    # 一定間隔で眠り、予定より遅れて起きた分をループの遅れとして記録する
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        watchdog.beat()
+        metrics.observe("ticket_loop_lag_seconds", (), max(0.0, loop.time() - expected))
+
+# ループのスレッドで有効にしているプロファイラー（PROFILE_MINUTES が0ならNone）
+profiler = None
+
+def write_profile(finished, path):
+    # I/Oスレッドで実行する。止めたプロファイラーを書き出し、保持数を超えた古いものを消す
+    finished.dump_stats(path)
+    names = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".prof"))
+    for name in names[:-PROFILE_RETENTION]:
+        os.remove(os.path.join(PROFILE_DIR, name))
+
+async def dump_profiles():
+    global profiler
+    while True:
+        await asyncio.sleep(PROFILE_MINUTES * 60)
+        finished, profiler = profiler, cProfile.Profile()
+        finished.disable()
+        profiler.enable()
+        path = os.path.join(PROFILE_DIR, f"profile_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.prof")
+        await run_io(write_profile, finished, path)
+
+def start_profiling():
+    global profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    spawn(dump_profiles())
 
 # Intentsの設定
 intents = discord.Intents.default()
@@ -17,30 +412,979 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True  # メッセージ内容へのアクセスを許可
 
+# 省メモリモード（python ticket.py --low-memory）: 起動時に全メンバーを取得せず、メンバーとメッセージをキャッシュしない。
+# 権限の確認はインタラクションに含まれるロール情報で行い、DMの宛先などは必要になった時に取得する
+LOW_MEMORY_MODE = "--low-memory" in sys.argv
+if LOW_MEMORY_MODE:
+    bot_options = {
+        "chunk_guilds_at_startup": False,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "max_messages": None,
+    }
+else:
+    bot_options = {}
+
 # Botインスタンスの作成
-bot = commands.Bot(command_prefix="/", intents=intents)
-
-# チケット用の設定を保持する辞書（既存機能は変更せずに保持）
-settings = {
-    "ticket": {},
-    "panel_title": {},
-    "panel_description": {},
-    "panel_url": {},
-    "staff_role": {},
-    "developed_info": {},
-    "dm_message": {},
-    "embed_title": {},
-    "embed_description": {},
-    "embed_color": {},
-    "link": {},
-    "panel_image": {},
-    "panel_color": {},
-    "top_right_image": {},
-    "developer_text": {},
-    "developer_image": {},
-    "open_image": {},
-    "close_image": {},
-}
+bot = commands.Bot(command_prefix="/", intents=intents, http_trace=rest_trace, **bot_options)
+
+class TicketButton:
+    # チケット作成ボタン1つ分の設定（保存ファイルでは "ticket" の各要素）
+    # pool_size はカテゴリーに事前作成しておくチャンネル数（0でウォームプールを使わない）
+    # idle_hours は発言がないまま自動で閉じるまでの時間（0で自動クローズしない）
+    __slots__ = ("category", "emoji", "name", "description", "ticket_role", "pool_size", "idle_hours")
+
+    def __init__(self, category, emoji, name, description, ticket_role=None, pool_size=0, idle_hours=0):
+        self.category = category
+        self.emoji = emoji
+        self.name = name
+        self.description = description
+        self.ticket_role = ticket_role
+        self.pool_size = pool_size
+        self.idle_hours = idle_hours
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            int(data["category"]), data.get("emoji"), data["name"], data.get("description"),
+            data.get("ticket_role"), data.get("pool_size", 0), data.get("idle_hours", 0)
+        )
+
+    def to_dict(self):
+        return {
+            "category": self.category,
+            "emoji": self.emoji,
+            "name": self.name,
+            "description": self.description,
+            "ticket_role": self.ticket_role,
+            "pool_size": self.pool_size,
+            "idle_hours": self.idle_hours,
+        }
+
+class ImageAsset:
+    # キャッシュ済み画像への参照（保存ファイルでは {"sha256": ..., "filename": ...}）
+    __slots__ = ("digest", "filename")
+
+    def __init__(self, digest, filename):
+        self.digest = digest
+        self.filename = filename
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["sha256"], data["filename"])
+
+    def to_dict(self):
+        return {"sha256": self.digest, "filename": self.filename}
+
+class GuildConfig:
+    # 1ギルド分の設定。属性名は保存ファイルのフィールド名と同じ
+    __slots__ = (
+        "ticket",
+        "panel_title",
+        "panel_description",
+        "panel_url",
+        "staff_role",
+        "developed_info",
+        "dm_message",
+        "embed_title",
+        "embed_description",
+        "embed_color",
+        "link",
+        "panel_image",
+        "panel_color",
+        "top_right_image",
+        "developer_text",
+        "developer_image",
+        "open_image",
+        "close_image",
+        "url_channels",
+    )
+
+    def __init__(self):
+        self.ticket = []
+        self.panel_title = "チケットサポート"
+        self.panel_description = "以下のボタンを押してチケットを開いてください。"
+        self.panel_url = None
+        self.staff_role = None
+        self.developed_info = {}
+        self.dm_message = ""
+        self.embed_title = "チケット"
+        self.embed_description = "サポートが必要ですか？"
+        self.embed_color = discord.Color.blue()
+        self.link = ""
+        self.panel_image = None
+        self.panel_color = discord.Color.blue()
+        self.top_right_image = None
+        self.developer_text = None
+        self.developer_image = None
+        self.open_image = None
+        self.close_image = None
+        # 添付画像のURLを返信するチャンネル（on_messageで毎回引くので集合で持つ）
+        self.url_channels = frozenset()
+
+    def set_field(self, field, value):
+        # 保存形式の値を変換して設定する。未知のフィールドは無視する
+        if field in GuildConfig.__slots__:
+            setattr(self, field, deserialize_value(field, value))
+            return True
+        return False
+
+    def fields(self):
+        # 既定値から変更されたフィールドだけを (field, value) で返す
+        for field in GuildConfig.__slots__:
+            value = getattr(self, field)
+            if value != getattr(DEFAULT_CONFIG, field):
+                yield field, value
+
+DEFAULT_CONFIG = GuildConfig()
+# guild_id -> GuildConfig
+guild_configs = {}
+
+def get_config(guild_id):
+    config = guild_configs.get(guild_id)
+    if config is None:
+        config = guild_configs[guild_id] = GuildConfig()
+    return config
+
+def serialize_value(value):
+    # Convert discord.Color to its integer value
+    if isinstance(value, discord.Color):
+        return value.value
+    if isinstance(value, (TicketButton, ImageAsset)):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [serialize_value(item) for item in value]
+    if isinstance(value, frozenset):
+        return sorted(value)
+    # For attachments, store the URL if available
+    if hasattr(value, "url"):
+        return value.url
+    return value
+
+def deserialize_value(key, value):
+    if key in ("embed_color", "panel_color") and isinstance(value, int):
+        return discord.Color(value)
+    if key == "ticket" and isinstance(value, list):
+        return [TicketButton.from_dict(item) for item in value]
+    if key in IMAGE_FIELDS and isinstance(value, dict):
+        return ImageAsset.from_dict(value)
+    if key == "url_channels" and isinstance(value, list):
+        return frozenset(value)
+    return value
+
+class SettingsStore:
+    # (field, guild_id) ごとに1行で設定を永続化するSQLiteストア
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS settings ("
+            "field TEXT NOT NULL, guild_id INTEGER NOT NULL, value TEXT, "
+            "PRIMARY KEY (field, guild_id))"
+        )
+        self.conn.commit()
+
+    def load_all(self):
+        return [
+            (field, guild_id, json.loads(value))
+            for field, guild_id, value in self.conn.execute("SELECT field, guild_id, value FROM settings")
+        ]
+
+    def put_many(self, rows):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO settings (field, guild_id, value) VALUES (?, ?, ?)",
+                [(field, guild_id, json.dumps(serialize_value(value), ensure_ascii=False)) for field, guild_id, value in rows]
+            )
+
+def serialize_settings(configs=None):
+    # 保存ファイルは従来どおりフィールドごと（field -> guild_id -> value）の形式で書き出す
+    serialized = {field: {} for field in GuildConfig.__slots__}
+    for guild_id, config in guild_configs.items() if configs is None else configs:
+        for field, value in config.fields():
+            serialized[field][guild_id] = serialize_value(value)
+    return serialized
+
+def settings_by_guild(data):
+    # 保存ファイル形式（field -> guild_id -> value）をギルドごと（guild_id -> field -> value）に並べ替える
+    by_guild = {}
+    for key, guild_data in data.items():
+        if isinstance(guild_data, dict):
+            for guild_id, value in guild_data.items():
+                by_guild.setdefault(str(guild_id), {})[key] = value
+    return by_guild
+
+def catalog_entry(filename, timestamp, payload, guild_count):
+    # 索引の1件はギルド数に関係なく同じ大きさにする。ギルドごとの位置は保存ごとの索引ファイルに置く
+    return {
+        "file": filename,
+        "timestamp": timestamp,
+        "guild_count": guild_count,
+        "size": len(payload),
+        "sha256": hashlib.sha256(payload).hexdigest(),
+    }
+
+def slices_path(filename):
+    return os.path.join(SAVE_DIR, filename[:-len(".json")] + ".guilds.jsonl")
+
+def slice_index_path(filename):
+    return os.path.join(SAVE_DIR, filename[:-len(".json")] + ".guilds.idx")
+
+def write_slices(filename, data):
+    # 1ギルド1行のサイドカーと、その索引（昇順のguild_id n個と、行の開始位置 n+1個の64bit整数）を書く
+    guild_ids, offsets, lines = array.array("q"), array.array("q", [0]), []
+    for guild_id, fields in sorted((int(guild_id), fields) for guild_id, fields in settings_by_guild(data).items()):
+        line = (json.dumps(fields, ensure_ascii=False) + "\n").encode("utf-8")
+        guild_ids.append(guild_id)
+        offsets.append(offsets[-1] + len(line))
+        lines.append(line)
+    write_bytes_atomic(slices_path(filename), b"".join(lines))
+    write_bytes_atomic(slice_index_path(filename), guild_ids.tobytes() + offsets.tobytes())
+    return len(guild_ids)
+
+def read_slice_index(filename):
+    # (guild_idの配列, 行の開始位置の配列) を返す。索引が無ければNone
+    try:
+        with open(slice_index_path(filename), "rb") as f:
+            payload = f.read()
+    except FileNotFoundError:
+        return None
+    count = (len(payload) // 8 - 1) // 2
+    guild_ids, offsets = array.array("q"), array.array("q")
+    guild_ids.frombytes(payload[:count * 8])
+    offsets.frombytes(payload[count * 8:])
+    return guild_ids, offsets
+
+def index_snapshot(filename, timestamp):
+    # 索引の形式が変わる前の保存ファイルを読み直し、サイドカーと索引を作る。読めなければNone
+    try:
+        with open(os.path.join(SAVE_DIR, filename), "rb") as f:
+            payload = f.read()
+        data = json.loads(payload)
+    except (FileNotFoundError, ValueError):
+        log.warning("保存ファイル %s を読み込めないため索引に加えません", filename)
+        return None
+    return catalog_entry(filename, timestamp, payload, write_slices(filename, data))
+
+class SaveCatalog:
+    # 保存ファイルの索引。/ticket_road はディレクトリを走査せずにこれだけを参照する
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, "catalog.json")
+        self.entries = []
+        # guild_id -> そのギルドを含む保存ファイル名の一覧。/ticket_road で初めて使う時に索引ファイルから作る
+        self.guilds = None
+
+    def open(self):
+        entries = read_json(self.path)
+        if entries is None:
+            # 索引導入前の保存ファイルは初回起動時に一度だけ読み込んで索引に加える
+            entries = [
+                {"file": filename, "timestamp": filename[len("ticket_save_"):-len(".json")]}
+                for filename in sorted(os.listdir(self.directory))
+                if filename.startswith("ticket_save_") and filename.endswith(".json")
+            ]
+        if entries is None or any("guild_count" not in entry for entry in entries):
+            # ギルドの一覧や位置を索引に持っていた古い形式も、一度だけ読み直して索引ファイルに移す
+            entries = [
+                entry if "guild_count" in entry else index_snapshot(entry["file"], entry["timestamp"])
+                for entry in entries
+            ]
+            entries = [entry for entry in entries if entry is not None]
+            write_json_atomic(self.path, entries)
+        self.entries = entries
+
+    def add(self, entry):
+        self.entries = [e for e in self.entries if e["file"] != entry["file"]] + [entry]
+        if self.guilds is not None:
+            self.unindex({entry["file"]})
+            self.index(entry)
+        self.flush()
+
+    def remove(self, filenames):
+        if filenames:
+            self.entries = [e for e in self.entries if e["file"] not in filenames]
+            if self.guilds is not None:
+                self.unindex(set(filenames))
+            self.flush()
+
+    def index(self, entry):
+        index = read_slice_index(entry["file"])
+        if index is not None:
+            for guild_id in index[0]:
+                self.guilds.setdefault(guild_id, []).append(entry["file"])
+
+    def unindex(self, filenames):
+        for guild_id, files in list(self.guilds.items()):
+            if any(filename in filenames for filename in files):
+                files[:] = [filename for filename in files if filename not in filenames]
+                if not files:
+                    del self.guilds[guild_id]
+
+    def flush(self):
+        write_json_atomic(self.path, self.entries)
+
+    def for_guild(self, guild_id):
+        # I/Oスレッドで実行する。guild_id を含む保存を新しい順に返す
+        if self.guilds is None:
+            self.guilds = {}
+            for entry in self.entries:
+                self.index(entry)
+        files = set(self.guilds.get(guild_id, ()))
+        return [e for e in reversed(self.entries) if e["file"] in files]
+
+def slice_position(guild_ids, guild_id):
+    position = bisect.bisect_left(guild_ids, guild_id)
+    if position == len(guild_ids) or guild_ids[position] != guild_id:
+        return None
+    return position
+
+def write_snapshot(data, timestamp):
+    filename = f"ticket_save_{timestamp}.json"
+    payload = write_json_atomic(os.path.join(SAVE_DIR, filename), data, indent=4)
+    # 1ギルド1行のサイドカーも書き、1ギルド分だけ読めるようにする
+    return catalog_entry(filename, timestamp, payload, write_slices(filename, data))
+
+def read_guild_slice(entry, guild_id):
+    # I/Oスレッドで実行する。保存ファイルから guild_id の設定（field -> value）だけを返す
+    index = read_slice_index(entry["file"])
+    if index is None:
+        return None
+    guild_ids, offsets = index
+    position = slice_position(guild_ids, guild_id)
+    if position is None:
+        return {}
+    try:
+        with open(slices_path(entry["file"]), "rb") as f:
+            f.seek(offsets[position])
+            return json.loads(f.read(offsets[position + 1] - offsets[position]))
+    except FileNotFoundError:
+        return None
+
+class SettingsJournal:
+    # 設定変更の追記ログ。journal.jsonl に書き込み、圧縮時に journal_{timestamp}.jsonl へローテートする
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, "journal.jsonl")
+        self.pending = 0
+
+    def open(self):
+        # 前回の起動で畳み込まれずに残った記録があれば次回の圧縮対象にする
+        if os.path.exists(self.path):
+            self.pending = os.path.getsize(self.path)
+
+    def append(self, rows):
+        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        with open(self.path, "a", encoding="utf-8") as f:
+            for field, guild_id, value in rows:
+                f.write(json.dumps(
+                    {"ts": timestamp, "field": field, "guild_id": guild_id, "value": serialize_value(value)},
+                    ensure_ascii=False
+                ) + "\n")
+        self.pending += len(rows)
+
+    def rotate(self, timestamp):
+        # timestamp のスナップショットに含まれた記録を区切る
+        if os.path.exists(self.path):
+            os.replace(self.path, os.path.join(self.directory, f"journal_{timestamp}.jsonl"))
+        self.pending = 0
+
+    def snapshots(self):
+        return sorted(
+            f[len("ticket_save_"):-len(".json")]
+            for f in os.listdir(self.directory)
+            if f.startswith("ticket_save_") and f.endswith(".json")
+        )
+
+    def segments(self):
+        return sorted(
+            f[len("journal_"):-len(".jsonl")]
+            for f in os.listdir(self.directory)
+            if f.startswith("journal_") and f.endswith(".jsonl")
+        )
+
+    def prune(self):
+        # 保持数を超えた古いスナップショットを削除し、削除したファイル名を返す
+        snapshots = self.snapshots()
+        if len(snapshots) <= SNAPSHOT_RETENTION:
+            return []
+        removed = []
+        for timestamp in snapshots[:-SNAPSHOT_RETENTION]:
+            removed.append(f"ticket_save_{timestamp}.json")
+            os.remove(os.path.join(self.directory, removed[-1]))
+            for path in (slices_path(removed[-1]), slice_index_path(removed[-1])):
+                if os.path.exists(path):
+                    os.remove(path)
+        # 最古の保持スナップショット以前の記録しか持たないセグメントは復元に使われない
+        oldest = snapshots[-SNAPSHOT_RETENTION]
+        for timestamp in self.segments():
+            if timestamp <= oldest:
+                os.remove(os.path.join(self.directory, f"journal_{timestamp}.jsonl"))
+        return removed
+
+    def replay(self, fields, base, timestamp, guild_id):
+        # base のスナップショットから取り出した guild_id の設定に、timestamp までのそのギルドの記録を順に適用する
+        paths = [os.path.join(self.directory, f"journal_{t}.jsonl") for t in self.segments() if t >= base]
+        paths.append(self.path)
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で落ちた末尾行は無視する
+                        continue
+                    # スナップショットは秒単位なので同じ秒の記録も再生する（順に適用すれば結果は変わらない）
+                    if record["guild_id"] == guild_id and base <= record["ts"] <= timestamp:
+                        fields[record["field"]] = record["value"]
+        return fields
+
+def cdn_url_alive(url):
+    # DiscordのCDN URLは ex=（16進のUNIX時刻）で失効する。送信中に切れないよう1時間の余裕を見る
+    expires = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("ex")
+    if not expires:
+        return True
+    try:
+        return int(expires[0], 16) - 3600 > time.time()
+    except ValueError:
+        return True
+
+def optimize_image(data):
+    # 画像処理プロセスで実行する。縮小してメタデータを落とし、元より小さくなった場合だけ
+    # (bytes, 拡張子) を返す。GIFアニメはフレームと表示時間を保ったままGIFで書き出す。
+    # スマートフォンの写真は向きをEXIFで持つので、メタデータを落とす前に画素の向きへ反映する
+    try:
+        image = Image.open(io.BytesIO(data))
+        animated = getattr(image, "is_animated", False)
+        out = io.BytesIO()
+        if animated:
+            frames, durations = [], []
+            for frame in ImageSequence.Iterator(image):
+                durations.append(frame.info.get("duration", image.info.get("duration", 100)))
+                frame = ImageOps.exif_transpose(frame).convert("RGBA")
+                frame.thumbnail(IMAGE_MAX_SIZE)
+                frames.append(frame)
+            frames[0].save(
+                out, format="GIF", save_all=True, append_images=frames[1:], duration=durations,
+                loop=image.info.get("loop", 0), disposal=2, optimize=True
+            )
+            candidates = [(out.getvalue(), "gif")]
+        else:
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+            image.thumbnail(IMAGE_MAX_SIZE)
+            image.save(out, format="WEBP", quality=85, method=6)
+            png = io.BytesIO()
+            image.save(png, format="PNG", optimize=True)
+            candidates = [(out.getvalue(), "webp"), (png.getvalue(), "png")]
+    except Exception:
+        return None
+    optimized, ext = min(candidates, key=lambda candidate: len(candidate[0]))
+    if len(optimized) >= len(data):
+        return None
+    return optimized, ext
+
+class ImageCache:
+    # sha256 -> 画像ファイルのキャッシュ。I/Oスレッドで実行する（lookup系を除く）
+    # index.json には古い順（LRU順）にエントリを並べ、取得元URLとアップロード済みURLも記録する
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.path = os.path.join(directory, "index.json")
+        self.max_bytes = max_bytes
+        # digest -> {"sha256", "filename", "size", "url"}。再圧縮済みの版があれば "optimized" にそのdigest
+        self.entries = OrderedDict()
+        self.sources = {}  # 取得元の添付URL -> digest
+
+    def file_path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        data = read_json(self.path) or {"entries": [], "sources": {}}
+        self.entries = OrderedDict(
+            (entry["sha256"], entry) for entry in data["entries"] if os.path.exists(self.file_path(entry["sha256"]))
+        )
+        self.sources = {url: digest for url, digest in data["sources"].items() if digest in self.entries}
+
+    def put(self, data, filename, source=None, keep=()):
+        # 同じ内容の画像は1つだけ保存する。keep（設定中の画像）は追い出さない
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.entries:
+            write_bytes_atomic(self.file_path(digest), data)
+            self.entries[digest] = {"sha256": digest, "filename": filename, "size": len(data), "url": None}
+        self.entries.move_to_end(digest)
+        if source:
+            self.sources[source] = digest
+            # 設定時の添付URLは失効するまでそのまま使える
+            if not self.entries[digest]["url"]:
+                self.entries[digest]["url"] = source
+        self.evict(set(keep) | {digest})
+        self.flush()
+        return digest
+
+    def put_variant(self, digest, data, filename, keep=()):
+        # 元画像と再圧縮版の両方を残し、送信時は再圧縮版を使う
+        variant = self.put(data, filename, keep=set(keep) | {digest})
+        if digest in self.entries:
+            self.entries[digest]["optimized"] = variant
+            self.flush()
+        return variant
+
+    def variant(self, digest):
+        # イベントループから呼ぶ。送信に使う (digest, filename)
+        entry = self.entries.get(digest)
+        if entry is None:
+            return digest, None
+        optimized = self.entries.get(entry.get("optimized"))
+        if optimized is not None:
+            return optimized["sha256"], optimized["filename"]
+        return digest, entry["filename"]
+
+    def read(self, digest):
+        if digest not in self.entries:
+            return None
+        self.entries.move_to_end(digest)
+        try:
+            with open(self.file_path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set_url(self, digest, url):
+        if digest in self.entries:
+            self.entries[digest]["url"] = url
+            self.flush()
+
+    def evict(self, keep):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for digest in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if digest in keep:
+                continue
+            total -= self.entries.pop(digest)["size"]
+            try:
+                os.remove(self.file_path(digest))
+            except FileNotFoundError:
+                pass
+        self.sources = {url: digest for url, digest in self.sources.items() if digest in self.entries}
+
+    def flush(self):
+        write_json_atomic(self.path, {"entries": list(self.entries.values()), "sources": self.sources})
+
+    def cached_url(self, digest):
+        # イベントループから呼ぶ。まだ使えるアップロード済みURLがあれば返す
+        entry = self.entries.get(digest)
+        if entry and entry["url"] and cdn_url_alive(entry["url"]):
+            return entry["url"]
+        return None
+
+settings_store = SettingsStore(SETTINGS_DB)
+settings_journal = SettingsJournal(SAVE_DIR)
+save_catalog = SaveCatalog(SAVE_DIR)
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+def restore_guild(timestamp, guild_id):
+    # I/Oスレッドで実行する。timestamp 以前で最新のスナップショットにジャーナルを再生した guild_id の設定を返す
+    bases = [e for e in save_catalog.entries if e["timestamp"] <= timestamp]
+    if not bases:
+        return None
+    base = max(bases, key=lambda e: e["timestamp"])
+    fields = read_guild_slice(base, guild_id)
+    if fields is None:
+        return None
+    return settings_journal.replay(fields, base["timestamp"], timestamp, guild_id)
+
+def save_settings_snapshot(configs, timestamp):
+    # I/Oスレッドで実行する。ループ上で写し取った (guild_id, GuildConfig) の一覧を変換して保存する。
+    # GuildConfigの値は変更時に丸ごと置き換えられ、その場では書き換えられないので別スレッドから読める
+    return save_snapshot(serialize_settings(configs), timestamp)
+
+def save_snapshot(data, timestamp):
+    # I/Oスレッドで実行する。スナップショットを書いて索引に加え、
+    # ジャーナルモードではログを区切って保持数を超えた分を削除する
+    entry = write_snapshot(data, timestamp)
+    save_catalog.add(entry)
+    if JOURNAL_MODE:
+        settings_journal.rotate(timestamp)
+        save_catalog.remove(settings_journal.prune())
+    return entry
+
+def write_rows(rows):
+    settings_store.put_many(rows)
+    if JOURNAL_MODE:
+        settings_journal.append(rows)
+
+def persist_rows(rows):
+    # 値の変換だけループ上で済ませ、ディスクへの書き込みはI/Oスレッドに任せる
+    return submit_io(write_rows, [(field, guild_id, serialize_value(value)) for field, guild_id, value in rows])
+
+def set_settings(guild_id, **values):
+    # メモリ上のGuildConfig（読み取りキャッシュ）を更新し、変更した行だけをSQLiteへ書き込む
+    config = get_config(guild_id)
+    for key, value in values.items():
+        setattr(config, key, value)
+    invalidate_templates(guild_id)
+    persist_rows([(key, guild_id, value) for key, value in values.items()])
+
+def apply_guild_settings(guild_id, fields):
+    # 1ギルド分の設定（field -> value）をGuildConfigにマージし、変更行を返す。他のギルドには触れない
+    config = get_config(guild_id)
+    invalidate_templates(guild_id)
+    return [(key, guild_id, value) for key, value in fields.items() if config.set_field(key, value)]
+
+def replace_guild_settings(guild_id, fields):
+    # 時点復元用。1ギルド分の設定を既定値に戻してから fields を適用し、値の変わった行を返す
+    # （その時点で未設定だったフィールドも既定値に戻るよう、変わった既定値の行も書き込む）
+    config = get_config(guild_id)
+    target = {field: serialize_value(getattr(DEFAULT_CONFIG, field)) for field in GuildConfig.__slots__}
+    target.update((key, value) for key, value in fields.items() if key in target)
+    rows = [(key, guild_id, value) for key, value in target.items() if serialize_value(getattr(config, key)) != value]
+    for key, _, value in rows:
+        config.set_field(key, value)
+    invalidate_templates(guild_id)
+    return rows
+
+def load_settings_from_rows(rows):
+    for field, guild_id, value in rows:
+        get_config(guild_id).set_field(field, value)
+
+# オープン中のチケットの登録簿: (guild_id, user_id) -> channel_id
+open_tickets = {}
+# 逆引き用: channel_id -> (guild_id, user_id)
+ticket_owners = {}
+TICKET_PREFIXES = ("ticket-", "📌ticket-")
+# 作成中のチケット: (guild_id, user_id) -> 作成されたチャンネルを返すFuture
+pending_tickets = {}
+# ウォームプール: category_id -> 事前作成済みで未使用のchannel_idのリスト
+warm_pools = {}
+
+def register_ticket(guild_id, user_id, channel_id):
+    open_tickets[(guild_id, user_id)] = channel_id
+    ticket_owners[channel_id] = (guild_id, user_id)
+
+def unregister_ticket(channel_id):
+    untrack_idle(channel_id)
+    for pool in warm_pools.values():
+        if channel_id in pool:
+            pool.remove(channel_id)
+    owner = ticket_owners.pop(channel_id, None)
+    if owner and open_tickets.get(owner) == channel_id:
+        del open_tickets[owner]
+    return owner
+
+def find_open_ticket(guild, user_id):
+    channel_id = open_tickets.get((guild.id, user_id))
+    if channel_id is None:
+        return None
+    channel = guild.get_channel(channel_id)
+    if channel is None:
+        # 取りこぼした削除イベントの後始末
+        unregister_ticket(channel_id)
+    return channel
+
+def rebuild_ticket_registry():
+    # 起動時に一度だけ全チャンネルを走査し、権限上書きからチケットの作成者を復元する
+    open_tickets.clear()
+    ticket_owners.clear()
+    warm_pools.clear()
+    for guild in bot.guilds:
+        for channel in guild.text_channels:
+            if channel.name == WARM_POOL_NAME and channel.category_id:
+                warm_pools.setdefault(channel.category_id, []).append(channel.id)
+                continue
+            if not channel.name.startswith(TICKET_PREFIXES):
+                continue
+            for target, overwrite in channel.overwrites.items():
+                is_member = isinstance(target, discord.Member) or (
+                    # キャッシュに無いメンバーはロール以外の type を持つ Object になる
+                    isinstance(target, discord.Object) and target.type is not discord.Role
+                )
+                if is_member and target.id != bot.user.id and overwrite.send_messages:
+                    register_ticket(guild.id, target.id, channel.id)
+                    break
+
+class StatsStore:
+    # 日ごとの集計と、オープン中チケットの作成情報を持つSQLiteストア。I/Oスレッドで実行する
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS daily ("
+            "guild_id INTEGER NOT NULL, day INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (guild_id, day));"
+            "CREATE TABLE IF NOT EXISTS tickets ("
+            "channel_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, button INTEGER, category INTEGER, opened_at REAL);"
+        )
+
+    def load(self, since_day):
+        return [
+            (guild_id, day, json.loads(data))
+            for guild_id, day, data in self.conn.execute("SELECT guild_id, day, data FROM daily WHERE day >= ?", (since_day,))
+        ]
+
+    def load_tickets(self):
+        return self.conn.execute("SELECT channel_id, guild_id, button, category, opened_at FROM tickets").fetchall()
+
+    def put_day(self, guild_id, day, data):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO daily (guild_id, day, data) VALUES (?, ?, ?)", (guild_id, day, data))
+
+    def put_ticket(self, channel_id, guild_id, button, category, opened_at):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tickets (channel_id, guild_id, button, category, opened_at) VALUES (?, ?, ?, ?, ?)",
+                (channel_id, guild_id, button, category, opened_at)
+            )
+
+    def delete_ticket(self, channel_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM tickets WHERE channel_id = ?", (channel_id,))
+
+stats_store = StatsStore(STATS_DB)
+# guild_id -> {day: 集計}。day はUNIX時刻を86400で割った日番号（UTC）
+guild_stats = {}
+# オープン中チケットの channel_id -> (guild_id, ボタンのindex, category_id, 作成時刻)
+ticket_info = {}
+# ボタン・カテゴリーごとの集計 [opened, pinned, closed] の位置
+EVENT_SLOTS = {"opened": 0, "pinned": 1, "closed": 2}
+
+def new_day_stats():
+    return {
+        "opened": 0,
+        "pinned": 0,
+        "closed": 0,
+        "buttons": {},
+        "categories": {},
+        "close_hist": [0] * (len(CLOSE_TIME_BOUNDS) + 1),
+        "close_total": 0.0,
+    }
+
+def record_event(guild_id, event, button, category, close_time=None):
+    # 当日分の集計に1件足すだけ（集計の件数に関係なく一定時間）
+    day = int(time.time() // 86400)
+    days = guild_stats.setdefault(guild_id, {})
+    stats = days.get(day)
+    if stats is None:
+        stats = days[day] = new_day_stats()
+        for old in [old for old in days if old <= day - STATS_DAYS]:
+            del days[old]
+    stats[event] += 1
+    slot = EVENT_SLOTS[event]
+    stats["buttons"].setdefault(str(button), [0, 0, 0])[slot] += 1
+    stats["categories"].setdefault(str(category), [0, 0, 0])[slot] += 1
+    if close_time is not None:
+        stats["close_hist"][bisect.bisect_left(CLOSE_TIME_BOUNDS, close_time)] += 1
+        stats["close_total"] += close_time
+    submit_io(stats_store.put_day, guild_id, day, json.dumps(stats))
+
+def record_opened(guild_id, channel_id, button, category):
+    opened_at = time.time()
+    ticket_info[channel_id] = (guild_id, button, category, opened_at)
+    record_event(guild_id, "opened", button, category)
+    submit_io(stats_store.put_ticket, channel_id, guild_id, button, category, opened_at)
+
+def record_pinned(channel):
+    _, button, category, _ = ticket_info.get(channel.id) or (None, -1, channel.category_id, None)
+    record_event(channel.guild.id, "pinned", button, category)
+
+def record_closed(channel):
+    info = ticket_info.pop(channel.id, None)
+    if info is None:
+        # 統計の導入前から開いていたチケット
+        info = (channel.guild.id, -1, channel.category_id, channel.created_at.timestamp())
+    _, button, category, opened_at = info
+    record_event(channel.guild.id, "closed", button, category, max(0.0, time.time() - opened_at))
+    submit_io(stats_store.delete_ticket, channel.id)
+
+def load_stats(rows, tickets):
+    for guild_id, day, data in rows:
+        guild_stats.setdefault(guild_id, {})[day] = data
+    for channel_id, guild_id, button, category, opened_at in tickets:
+        ticket_info[channel_id] = (guild_id, button, category, opened_at)
+
+def merge_stats(guild_id, days):
+    # 直近 days 日分の日ごとの集計を足し合わせる（最大 STATS_DAYS 件）
+    today = int(time.time() // 86400)
+    merged = new_day_stats()
+    for day, stats in guild_stats.get(guild_id, {}).items():
+        if day <= today - days:
+            continue
+        for key in ("opened", "pinned", "closed", "close_total"):
+            merged[key] += stats[key]
+        for group in ("buttons", "categories"):
+            for key, counts in stats[group].items():
+                total = merged[group].setdefault(key, [0, 0, 0])
+                for slot, count in enumerate(counts):
+                    total[slot] += count
+        for index, count in enumerate(stats["close_hist"]):
+            merged["close_hist"][index] += count
+    return merged
+
+def histogram_percentile(hist, q):
+    # q分位が入るビンの上限（秒）。最後のビンは上限なしなので None
+    target = q * sum(hist)
+    seen = 0
+    for index, count in enumerate(hist):
+        seen += count
+        if count and seen >= target:
+            return CLOSE_TIME_BOUNDS[index] if index < len(CLOSE_TIME_BOUNDS) else None
+    return None
+
+def format_duration(seconds):
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}分"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f}時間"
+    return f"{seconds / 86400:.1f}日"
+
+def format_percentile(hist, q):
+    bound = histogram_percentile(hist, q)
+    if bound is None:
+        return f"{format_duration(CLOSE_TIME_BOUNDS[-1])}超"
+    return f"{format_duration(bound)}以内"
+
+class IdleStore:
+    # 自動クローズの対象チケットと最終発言時刻。I/Oスレッドで実行する
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS idle ("
+            "channel_id INTEGER PRIMARY KEY, last_activity REAL NOT NULL, timeout REAL NOT NULL, warned INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    def load(self):
+        return self.conn.execute("SELECT channel_id, last_activity, timeout, warned FROM idle").fetchall()
+
+    def sync(self, rows, removed):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO idle (channel_id, last_activity, timeout, warned) VALUES (?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM idle WHERE channel_id = ?", [(channel_id,) for channel_id in removed])
+
+idle_store = IdleStore(IDLE_DB)
+# channel_id -> [最終発言時刻, タイムアウト秒, 警告済みか]
+idle_tickets = {}
+# (予定時刻, channel_id) のヒープ。発言のたびに入れ直さず、取り出した時に実際の予定時刻を計算し直す。
+# 発言は予定を遅らせるだけなので、ヒープ上の時刻が実際より遅くなることはない
+idle_heap = []
+idle_wakeup = asyncio.Event()
+# 前回の保存以降に変わった channel_id
+idle_dirty = set()
+# ギルドのキャッシュが揃っているか。起動直後と再接続（READYのやり直し）の間はキャッシュが空になる
+guild_cache_ready = asyncio.Event()
+
+def idle_due(state):
+    last_activity, timeout, warned = state
+    if warned:
+        return last_activity + timeout
+    return last_activity + timeout - min(IDLE_WARNING_SECONDS, timeout / 2)
+
+def schedule_idle(channel_id, state):
+    due = idle_due(state)
+    heapq.heappush(idle_heap, (due, channel_id))
+    if idle_heap[0] == (due, channel_id):
+        # 待っている時刻より早い予定が入ったのでスケジューラーを起こす
+        idle_wakeup.set()
+
+def track_idle(channel_id, timeout):
+    state = idle_tickets[channel_id] = [time.time(), timeout, False]
+    idle_dirty.add(channel_id)
+    schedule_idle(channel_id, state)
+
+def untrack_idle(channel_id):
+    # ヒープ上の予定はそのまま残し、取り出した時に読み飛ばす
+    if idle_tickets.pop(channel_id, None) is not None:
+        idle_dirty.add(channel_id)
+
+def touch_idle(channel_id):
+    # on_message から呼ばれる。辞書を1つ書き換えるだけ
+    state = idle_tickets.get(channel_id)
+    if state is not None:
+        state[0] = time.time()
+        state[2] = False
+        idle_dirty.add(channel_id)
+
+def load_idle(rows):
+    for channel_id, last_activity, timeout, warned in rows:
+        state = idle_tickets[channel_id] = [last_activity, timeout, bool(warned)]
+        idle_heap.append((idle_due(state), channel_id))
+    heapq.heapify(idle_heap)
+
+async def send_idle_warning(channel, state):
+    remaining = max(0, state[0] + state[1] - time.time())
+    try:
+        await rest_scheduler.submit(
+            channel.guild.id, "send", PRIORITY_UPDATE, channel.send,
+            f"このチケットは発言がないため、{format_duration(remaining)}後に自動的に閉じられます。"
+            "続ける場合は何か発言してください。",
+            channel_id=channel.id
+        )
+    except discord.HTTPException as error:
+        log.warning("チケット %s に自動クローズの警告を送れませんでした: %s", channel.id, error)
+
+async def idle_scheduler():
+    # 全チケットの自動クローズを1つのタスクで扱う。次の予定時刻まで眠るだけ
+    handler_labels.set(("idle_scheduler", "0"))
+    while True:
+        # キャッシュが揃うまでは、チャンネルが見つからなくても削除されたとは限らない
+        await guild_cache_ready.wait()
+        now = time.time()
+        while idle_heap and idle_heap[0][0] <= now:
+            _, channel_id = heapq.heappop(idle_heap)
+            state = idle_tickets.get(channel_id)
+            if state is None:
+                continue
+            if idle_due(state) > now:
+                # 最後に積んでから発言があった
+                heapq.heappush(idle_heap, (idle_due(state), channel_id))
+                continue
+            channel = bot.get_channel(channel_id)
+            if channel is None:
+                if any(guild.unavailable for guild in bot.guilds):
+                    # 障害で利用できないサーバーのチャンネルかもしれないので、後で確かめ直す
+                    heapq.heappush(idle_heap, (now + IDLE_RETRY_SECONDS, channel_id))
+                else:
+                    untrack_idle(channel_id)
+            elif not state[2]:
+                state[2] = True
+                idle_dirty.add(channel_id)
+                heapq.heappush(idle_heap, (idle_due(state), channel_id))
+                spawn(send_idle_warning(channel, state))
+            else:
+                owner = ticket_owners.get(channel_id)
+                enqueue_close(channel, owner[1] if owner else None)
+        idle_wakeup.clear()
+        delay = idle_heap[0][0] - now if idle_heap else None
+        try:
+            await asyncio.wait_for(idle_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+@tasks.loop(seconds=IDLE_FLUSH_SECONDS)
+async def flush_idle():
+    # 発言のたびに書き込まず、変わったチケットだけをまとめて保存する
+    if not idle_dirty:
+        return
+    rows, removed = [], []
+    for channel_id in idle_dirty:
+        state = idle_tickets.get(channel_id)
+        if state is None:
+            removed.append(channel_id)
+        else:
+            rows.append((channel_id, state[0], state[1], int(state[2])))
+    idle_dirty.clear()
+    await run_io(idle_store.sync, rows, removed)
 
 def create_ticket_embed(title="チケットサポート", description="以下のボタンを押してチケットを開いてください。", **kwargs):
     embed = discord.Embed(title=title, description=description, color=kwargs.get("color", discord.Color.blue()))
@@ -56,50 +1400,553 @@ def create_ticket_embed(title="チケットサポート", description="以下の
                 embed.set_thumbnail(url=value)
     return embed
 
+def image_url(image):
+    # Get the image URL correctly whether stored as attachment or URL string.
+    if hasattr(image, "url"):
+        return image.url
+    if isinstance(image, str):
+        return image
+    return None
+
+def avatar_url(user):
+    return user.avatar.url if user.avatar else None
+
+def referenced_images():
+    # いずれかのギルドで設定中の画像（キャッシュから追い出さない）
+    digests = set()
+    for config in guild_configs.values():
+        for field in IMAGE_FIELDS:
+            image = getattr(config, field)
+            if isinstance(image, ImageAsset):
+                digests.add(image.digest)
+                digests.add(image_cache.variant(image.digest)[0])
+    return digests
+
+async def cache_image(attachment):
+    # 設定された画像を一度だけ取得してキャッシュに入れる。同じ添付URLは再取得しない
+    digest = image_cache.sources.get(attachment.url)
+    if digest is None:
+        data = await attachment.read()
+        digest = await run_io(image_cache.put, data, attachment.filename, attachment.url, referenced_images())
+        if image_executor is not None and "optimized" not in image_cache.entries[digest]:
+            optimized = await asyncio.get_running_loop().run_in_executor(image_executor, optimize_image, data)
+            if optimized is not None:
+                data, ext = optimized
+                filename = f"{os.path.splitext(attachment.filename)[0]}.{ext}"
+                await run_io(image_cache.put_variant, digest, data, filename, referenced_images())
+    return ImageAsset(digest, attachment.filename)
+
+async def attach_image(embed, image):
+    # embedに画像を設定する。アップロード済みURLが使えなければキャッシュから添付するFileを返す
+    if not isinstance(image, ImageAsset):
+        if image_url(image):
+            embed.set_image(url=image_url(image))
+        return []
+    digest, filename = image_cache.variant(image.digest)
+    url = image_cache.cached_url(digest)
+    if url:
+        embed.set_image(url=url)
+        return []
+    data = await run_io(image_cache.read, digest)
+    if data is None:
+        log.warning("画像 %s がキャッシュにありません", digest)
+        return []
+    filename = filename or image.filename
+    embed.set_image(url=f"attachment://{filename}")
+    return [discord.File(io.BytesIO(data), filename=filename)]
+
+def remember_upload(image, message):
+    # 添付して送った画像のCDN URLを記録し、以降の送信ではURLだけを使う
+    if not isinstance(image, ImageAsset) or message is None:
+        return
+    digest = image_cache.variant(image.digest)[0]
+    if image_cache.cached_url(digest):
+        return
+    for embed in message.embeds:
+        if embed.image.url and embed.image.url.startswith("http"):
+            submit_io(image_cache.set_url, digest, embed.image.url)
+            return
+    if message.attachments:
+        submit_io(image_cache.set_url, digest, message.attachments[0].url)
+
+def ticket_select_options(buttons):
+    # buttonsは GuildConfig.ticket（TicketButtonのリスト）
+    return [
+        discord.SelectOption(
+            label=option.name,
+            value=f"{option.category}_{index}",
+            description=option.description,
+            emoji=option.emoji
+        )
+        for index, option in enumerate(buttons)
+    ]
+
+def build_panel_template(guild, config):
+    if config.panel_url:
+        embed = discord.Embed(
+            title=config.panel_title,
+            url=config.panel_url,
+            description=config.panel_description,
+            color=config.panel_color
+        )
+    else:
+        embed = discord.Embed(
+            title=config.panel_title,
+            description=config.panel_description,
+            color=config.panel_color
+        )
+    embed.set_author(name=guild.name, icon_url=guild.icon.url if guild.icon else None)
+    if config.developed_info:
+        embed.set_footer(text=config.developed_info.get("text"), icon_url=config.developed_info.get("icon_url"))
+    # 画像は送信時に attach_image() で設定する（アップロード済みURLの有無で変わるため）
+    return {"embed": embed, "image": config.panel_image, "view": TicketView(guild.id, ticket_select_options(config.ticket))}
+
+def build_open_template(guild, config):
+    embed = discord.Embed(
+        title=config.embed_title,
+        description=config.embed_description,
+        color=config.embed_color
+    ).set_author(
+        name=guild.name, icon_url=guild.icon.url if guild.icon else None
+    )
+    created = discord.Embed(
+        title="🎫 チケットが作成されました。",
+        description="下のボタンをクリックしてアクセスしてください。",
+        color=config.embed_color
+    )
+    # チケット作成時に通知するスタッフロールの取得
+    staff_role = guild.get_role(config.staff_role) if config.staff_role else None
+    return {
+        "embed": embed,
+        "image": config.open_image,
+        "created": created,
+        "staff_mention": staff_role.mention if staff_role else "",
+    }
+
+def build_close_template(guild, config):
+    embed = discord.Embed(
+        title="📄チケットが閉じました", description=config.dm_message, color=discord.Color.red()
+    ).set_author(
+        name=guild.name,
+        icon_url=guild.icon.url if guild.icon else None
+    )
+    view = discord.ui.View()
+    if config.link:
+        view.add_item(discord.ui.Button(
+            label="チケットをもう一度作成する",
+            style=discord.ButtonStyle.primary,
+            url=config.link
+        ))
+    return {"embed": embed, "image": config.close_image, "view": view, "enabled": bool(config.dm_message)}
+
+TEMPLATE_BUILDERS = {
+    "panel": build_panel_template,
+    "open": build_open_template,
+    "close": build_close_template,
+}
+# (guild_id, kind) -> 組み立て済みのEmbedなど。送信時はコピーしてユーザーごとの項目だけを埋める
+template_cache = {}
+
+def get_template(guild, kind):
+    template = template_cache.get((guild.id, kind))
+    if template is None:
+        template = template_cache[(guild.id, kind)] = TEMPLATE_BUILDERS[kind](guild, get_config(guild.id))
+    return template
+
+def invalidate_templates(guild_id):
+    for kind in TEMPLATE_BUILDERS:
+        template_cache.pop((guild_id, kind), None)
+
+# コンポーネントは DynamicItem として起動時に一度だけ登録し、custom_id で振り分ける。
+# メッセージごとのViewインスタンスはViewStoreに保持されない。
+class TicketSelect(discord.ui.DynamicItem[discord.ui.Select], template=r"ticket:select:(?P<guild_id>[0-9]+)"):
+    def __init__(self, guild_id, options=None):
+        # optionsは ticket_select_options() で組み立て済みのSelectOptionのリスト
+        super().__init__(discord.ui.Select(
+            custom_id=f"ticket:select:{guild_id}",
+            placeholder="チケットを開くカテゴリーを選択してください...",
+            options=options or [],
+        ))
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(int(match["guild_id"]), item.options)
+
+    @instrumented("ticket_select")
+    async def callback(self, interaction: discord.Interaction):
+        # 選択されたオプションのindexを取得し、対応するbutton_configを取り出す
+        index = int(self.item.values[0].split('_')[1])
+        buttons = get_config(interaction.guild.id).ticket
+        if self.guild_id != interaction.guild.id or index >= len(buttons):
+            await interaction.response.send_message("このパネルは古くなっています。/ticket_panel で作り直してください。", ephemeral=True)
+            return
+        button_config = buttons[index]
+        await create_ticket(interaction, button_config.category, button_config)
+
 class TicketView(discord.ui.View):
-    def __init__(self, options):
+    def __init__(self, guild_id, options):
         super().__init__(timeout=None)
-        self.add_item(TicketSelect(options))
+        self.add_item(TicketSelect(guild_id, options))
 
-class TicketSelect(discord.ui.Select):
-    def __init__(self, options):
-        # optionsは settings["ticket"][guild_id] のリスト
-        select_options = [
-            discord.SelectOption(
-                label=option["name"],
-                value=f"{option['category']}_{index}",
-                description=option["description"],
-                emoji=option["emoji"]
+# 実行中のバックグラウンド処理（参照を持っておかないと途中で回収される）
+background_tasks = set()
+# 段階名 -> [回数, 合計秒, 最大秒]
+stage_timings = {}
+
+def _task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("バックグラウンド処理でエラーが発生しました", exc_info=task.exception())
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+def is_transient(error):
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError, discord.DiscordServerError)):
+        return True
+    return isinstance(error, discord.HTTPException) and error.status in (429, 500, 502, 503, 504)
+
+def record_stage(stage, elapsed):
+    stats = stage_timings.setdefault(stage, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    metrics.observe("ticket_stage_seconds", (stage,), elapsed)
+    log.debug("%s: %.1fms", stage, elapsed * 1000)
+
+async def run_stage(stage, func, *args, **kwargs):
+    # 一時的なエラーは間隔を空けて再試行し、段階ごとの所要時間（再試行込み）を記録する
+    start = time.perf_counter()
+    try:
+        for attempt in range(TICKET_STAGE_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as error:
+                if attempt == TICKET_STAGE_RETRIES or not is_transient(error):
+                    raise
+                log.warning("%s に失敗したため再試行します（%d回目）: %s", stage, attempt + 1, error)
+                await asyncio.sleep(0.5 * 2 ** attempt)
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+class TokenBucket:
+    __slots__ = ("capacity", "per", "tokens", "updated")
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.per = per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        # 次の1回を実行できるまでの秒数（0なら今すぐ実行できる）
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.per)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) * self.per / self.capacity
+
+    def take(self):
+        self.tokens -= 1
+
+class RestOp:
+    __slots__ = ("kind", "channel_id", "func", "args", "kwargs", "futures", "handler", "submitted")
+
+    def __init__(self, kind, channel_id, func, args, kwargs, future):
+        self.kind = kind
+        self.channel_id = channel_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # 他の操作がまとめられた場合はその結果待ちも一緒に持つ
+        self.futures = [future]
+        # 実行時に計測のハンドラー名を引き継ぎ、予算待ちの時間を測る
+        self.handler = handler_labels.get()[0]
+        self.submitted = time.perf_counter()
+
+class RestScheduler:
+    # チャンネルの作成・変更・削除とメッセージ送信をギルドごとの優先度付きキューで実行する。
+    # discord.py に429を受けてから待たせるのではなく、予算の残っている操作から先に流す。
+    # キューは予算（バケット）ごとのヒープに分け、実行できるかは各ヒープの先頭だけを見て決める
+    def __init__(self, budgets, concurrency):
+        self.budgets = budgets
+        self.concurrency = concurrency
+        self.queues = {}  # guild_id -> {(kind, guild_id または channel_id): [(priority, seq, RestOp)]}
+        self.buckets = {}  # (kind, guild_id または channel_id) -> TokenBucket
+        self.deletes = {}  # channel_id -> 未実行の削除のRestOp
+        self.in_flight = {}  # guild_id -> 実行中の数
+        self.wakeups = {}  # guild_id -> Event
+        self.workers = {}  # guild_id -> Task
+        self.seq = itertools.count()
+
+    def depth(self, guild_id=None):
+        if guild_id is not None:
+            return sum(len(heap) for heap in self.queues.get(guild_id, {}).values())
+        return sum(len(heap) for queue in self.queues.values() for heap in queue.values())
+
+    def submit(self, guild_id, kind, priority, func, *args, channel_id=None, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(guild_id, {})
+        if kind == "delete" and channel_id is not None:
+            pending = self.deletes.get(channel_id)
+            if pending is not None:
+                # 同じチャンネルの削除は1回で済ませる
+                pending.futures.append(future)
+                return future
+            # 削除されるチャンネルへの未実行の変更（名前の変更など）は捨てる
+            for _, _, op in queue.pop(("edit", channel_id), ()):
+                for waiter in op.futures:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        op = RestOp(kind, channel_id, func, args, kwargs, future)
+        if kind == "delete" and channel_id is not None:
+            self.deletes[channel_id] = op
+        heapq.heappush(queue.setdefault(self.bucket_key(guild_id, kind, channel_id), []), (priority, next(self.seq), op))
+        if guild_id in self.workers:
+            self.wakeup(guild_id)
+        else:
+            self.wakeups[guild_id] = asyncio.Event()
+            self.workers[guild_id] = spawn(self.drain(guild_id))
+        return future
+
+    def wakeup(self, guild_id):
+        # ワーカーのいないギルドには待っている相手がいない
+        wakeup = self.wakeups.get(guild_id)
+        if wakeup is not None:
+            wakeup.set()
+
+    def forget_channel(self, channel_id):
+        # 削除されたチャンネルの予算は二度と使われないので捨てる
+        for kind in self.budgets:
+            self.buckets.pop((kind, channel_id), None)
+
+    def bucket_key(self, guild_id, kind, channel_id):
+        return (kind, guild_id if kind in ("create", "delete") or channel_id is None else channel_id)
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.budgets[key[0]])
+        return bucket
+
+    async def drain(self, guild_id):
+        queue = self.queues[guild_id]
+        wakeup = self.wakeups[guild_id]
+        try:
+            while queue:
+                wakeup.clear()
+                delay = None
+                if self.in_flight.get(guild_id, 0) < self.concurrency:
+                    # 予算の残っているヒープの先頭のうち、優先度と投入順で最初のものを実行する
+                    now = time.monotonic()
+                    ready = None
+                    for key, heap in queue.items():
+                        wait = self.bucket(key).delay(now)
+                        if wait:
+                            delay = wait if delay is None else min(delay, wait)
+                        elif ready is None or heap[0][:2] < queue[ready][0][:2]:
+                            ready = key
+                    if ready is not None:
+                        heap = queue[ready]
+                        op = heapq.heappop(heap)[2]
+                        if not heap:
+                            del queue[ready]
+                        if op.kind == "delete" and self.deletes.get(op.channel_id) is op:
+                            del self.deletes[op.channel_id]
+                        self.bucket(ready).take()
+                        self.in_flight[guild_id] = self.in_flight.get(guild_id, 0) + 1
+                        spawn(self.run(guild_id, op))
+                        continue
+                # 予算の回復・新しい操作・実行中の操作の完了のいずれかを待つ
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # キューが空になったギルドの状態は、次の操作が来たときに作り直す
+            del self.workers[guild_id]
+            del self.wakeups[guild_id]
+            if not queue:
+                del self.queues[guild_id]
+
+    async def run(self, guild_id, op):
+        guild = metric_guild(guild_id)
+        handler_labels.set((op.handler, guild))
+        metrics.observe("ticket_rest_wait_seconds", (op.kind, guild), time.perf_counter() - op.submitted)
+        try:
+            result = await op.func(*op.args, **op.kwargs)
+        except Exception as error:
+            for future in op.futures:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for future in op.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.in_flight[guild_id] -= 1
+            if not self.in_flight[guild_id]:
+                del self.in_flight[guild_id]
+            self.wakeup(guild_id)
+
+rest_scheduler = RestScheduler(REST_BUDGETS, REST_GUILD_CONCURRENCY)
+
+def warm_pool_targets(guild_id):
+    # category_id -> 目標数。同じカテゴリーのボタンが複数あれば大きい方に合わせる
+    targets = {}
+    config = guild_configs.get(guild_id)
+    for button in config.ticket if config is not None else ():
+        if button.pool_size:
+            targets[button.category] = max(targets.get(button.category, 0), button.pool_size)
+    return targets
+
+async def claim_warm_channel(guild, category, name, overwrites):
+    # 事前作成済みのチャンネルを名前と権限の変更だけでチケットにする。無ければNone
+    pool = warm_pools.get(category.id)
+    while pool:
+        channel = guild.get_channel(pool.pop())
+        if channel is None:
+            continue
+        try:
+            return await rest_scheduler.submit(
+                guild.id, "edit", PRIORITY_CREATE, channel.edit, name=name, overwrites=overwrites, channel_id=channel.id
             )
-            for index, option in enumerate(options)
-        ]
-        super().__init__(placeholder="チケットを開くカテゴリーを選択してください...", options=select_options)
+        except discord.NotFound:
+            continue
+        except discord.HTTPException:
+            # 再試行で同じチャンネルを使えるよう戻しておく
+            pool.append(channel.id)
+            raise
+    return None
 
-    async def callback(self, interaction: discord.Interaction):
-        # 選択されたオプションのindexを取得し、対応するbutton_configを取り出す
-        index = int(self.values[0].split('_')[1])
-        button_config = settings["ticket"][interaction.guild.id][index]
-        category_id = int(button_config["category"])
-        await create_ticket(interaction, category_id, button_config)
+def find_created_channel(channels, category, user_id):
+    # 応答を受け取れなかった作成が実は成功していた場合、そのチャンネルを探す
+    target = discord.Object(id=user_id)
+    for channel in channels:
+        if (
+            isinstance(channel, discord.TextChannel)
+            and channel.category_id == category.id
+            and channel.id not in ticket_owners
+            and channel.overwrites_for(target).send_messages
+        ):
+            return channel
+    return None
 
-async def create_ticket(interaction: discord.Interaction, category_id: int, button_config: dict, answers=None):
+async def create_ticket_channel(guild, category, name, overwrites, user_id):
+    channel = await claim_warm_channel(guild, category, name, overwrites)
+    if channel is not None:
+        return channel
+    try:
+        return await rest_scheduler.submit(
+            guild.id, "create", PRIORITY_CREATE, guild.create_text_channel, name=name, category=category, overwrites=overwrites
+        )
+    except Exception as error:
+        # 429と接続前の失敗は作成されていないので、そのまま再試行してよい
+        if not is_transient(error) or isinstance(error, aiohttp.ClientConnectorError) or getattr(error, "status", None) == 429:
+            raise
+        # タイムアウトや5xxはDiscord側で作成済みのことがある。再試行で二重に作らないよう先に確かめる
+        channel = find_created_channel(category.text_channels, category, user_id)
+        if channel is None:
+            try:
+                fetched = await guild.fetch_channels()
+            except Exception:
+                # 確かめられないときは、二重に作るよりも失敗として返す
+                raise RuntimeError("チャンネルが作成済みかどうかを確認できませんでした") from error
+            channel = find_created_channel(fetched, category, user_id)
+        if channel is None:
+            raise
+        log.warning("チャンネルの作成は応答を受け取れませんでしたが、作成済みのチャンネルを使います: %s", error)
+        return channel
+
+@tasks.loop(seconds=WARM_POOL_REFILL_SECONDS)
+async def refill_warm_pools():
+    # 1回あたりのREST呼び出しを WARM_POOL_REFILL_BUDGET に抑え、足りない分は次回に回す
+    budget = WARM_POOL_REFILL_BUDGET
+    handler_labels.set(("warm_pool", "0"))
+    # プールを設定したギルドと、減らすべきプールが残っているギルドだけを見る。
+    # get_config() は未設定のギルドにも設定を作るので、全ギルドを回しては呼ばない
+    categories = {}  # guild_id -> {category_id, ...}
+    for guild_id, config in guild_configs.items():
+        for button in config.ticket:
+            if button.pool_size:
+                categories.setdefault(guild_id, set()).add(button.category)
+    for category_id, pool in warm_pools.items():
+        category = bot.get_channel(category_id) if pool else None
+        if category is not None:
+            categories.setdefault(category.guild.id, set()).add(category_id)
+    for guild_id, category_ids in categories.items():
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            continue
+        targets = warm_pool_targets(guild_id)
+        for category_id in category_ids:
+            category = guild.get_channel(category_id)
+            if not isinstance(category, discord.CategoryChannel):
+                continue
+            pool = warm_pools.setdefault(category.id, [])
+            target = targets.get(category.id, 0)
+            while budget > 0 and len(pool) != target:
+                budget -= 1
+                try:
+                    if len(pool) < target:
+                        channel = await rest_scheduler.submit(
+                            guild.id, "create", PRIORITY_CLEANUP, category.create_text_channel,
+                            name=WARM_POOL_NAME,
+                            overwrites={guild.default_role: discord.PermissionOverwrite(read_messages=False)}
+                        )
+                        pool.append(channel.id)
+                    else:
+                        channel = guild.get_channel(pool.pop())
+                        if channel is not None:
+                            await rest_scheduler.submit(guild.id, "delete", PRIORITY_CLEANUP, channel.delete, channel_id=channel.id)
+                except discord.HTTPException as error:
+                    log.warning("ウォームプールの補充に失敗しました: %s", error)
+                    return
+            if not pool:
+                del warm_pools[category.id]
+            if budget <= 0:
+                return
+
+async def create_ticket(interaction: discord.Interaction, category_id: int, button_config: TicketButton, answers=None):
     guild = interaction.guild
     category = discord.utils.get(guild.categories, id=category_id)
     if not category:
         await interaction.response.send_message("カテゴリーが見つかりません！", ephemeral=True)
         return
 
-    if discord.utils.get(guild.text_channels, name=f"ticket-{interaction.user.name.lower()}"):
+    if find_open_ticket(guild, interaction.user.id):
         await interaction.response.send_message("既にチケットが開かれています！", ephemeral=True)
         return
 
-    # チケット作成時に通知するスタッフロールの取得
-    staff_role = discord.utils.get(guild.roles, id=settings["staff_role"].get(guild.id))
+    # 同じユーザーの作成処理が進行中なら、APIを叩かずにその結果を待つ
+    key = (guild.id, interaction.user.id)
+    pending = pending_tickets.get(key)
+    if pending is not None:
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        ticket_channel = await asyncio.shield(pending)
+        if ticket_channel is None:
+            # 先に進んでいた作成が失敗した。作成中ではないので失敗として知らせる
+            await interaction.followup.send("チケットの作成に失敗しました。時間をおいてもう一度お試しください。", ephemeral=True)
+        else:
+            await interaction.followup.send("既にチケットが開かれています！", view=VisitTicketView(ticket_channel), ephemeral=True)
+        return
+
+    # 登録簿を確かめてから最初のawaitまでに作成中として登録し、応答の保留を待つ間に来た連打を上の待機に回す
+    pending = pending_tickets[key] = asyncio.get_running_loop().create_future()
+    try:
+        # ここから先はRESTの混雑に左右されるので、3秒の応答期限に間に合うよう先に応答を保留する
+        await interaction.response.defer(ephemeral=True, thinking=True)
+    except Exception:
+        pending.set_result(None)
+        del pending_tickets[key]
+        raise
 
     # 追加：ボタンごとに指定されたticket_roleがあれば取得する
     ticket_role = None
-    if "ticket_role" in button_config and button_config["ticket_role"]:
-        ticket_role = guild.get_role(button_config["ticket_role"])
+    if button_config.ticket_role:
+        ticket_role = guild.get_role(button_config.ticket_role)
 
     overwrites = {
         guild.default_role: discord.PermissionOverwrite(read_messages=False),
@@ -109,60 +1956,76 @@ async def create_ticket(interaction: discord.Interaction, category_id: int, butt
     if ticket_role:
         overwrites[ticket_role] = discord.PermissionOverwrite(read_messages=True)
 
-    ticket_channel = await guild.create_text_channel(
-        name=f"ticket-{interaction.user.name}",
-        category=category,
-        overwrites=overwrites
-    )
+    # 残りの段階はバックグラウンドで進め、完了したらフォローアップで知らせる
+    spawn(ticket_pipeline(interaction, category, button_config, overwrites, answers))
 
-    embed_title = settings.get("embed_title", {}).get(guild.id, "チケット")
-    description = settings.get("embed_description", {}).get(guild.id, "サポートが必要ですか？")
-    color = settings.get("embed_color", {}).get(guild.id, discord.Color.blue())
-
-    # Get the open image URL correctly whether stored as attachment or URL string.
-    open_image_setting = settings["open_image"].get(guild.id)
-    if open_image_setting:
-        if hasattr(open_image_setting, "url"):
-            image_url = open_image_setting.url
-        elif isinstance(open_image_setting, str):
-            image_url = open_image_setting
-        else:
-            image_url = None
-    else:
-        image_url = None
+async def ticket_pipeline(interaction, category, button_config, overwrites, answers):
+    guild = interaction.guild
+    key = (guild.id, interaction.user.id)
+    pending = pending_tickets[key]
+    ticket_channel = None
+    try:
+        ticket_channel = await run_stage(
+            "create_channel",
+            create_ticket_channel,
+            guild,
+            category,
+            f"ticket-{interaction.user.name}",
+            overwrites,
+            interaction.user.id
+        )
+        register_ticket(guild.id, interaction.user.id, ticket_channel.id)
+        buttons = get_config(guild.id).ticket
+        record_opened(
+            guild.id, ticket_channel.id, buttons.index(button_config) if button_config in buttons else -1, category.id
+        )
+        if button_config.idle_hours:
+            track_idle(ticket_channel.id, button_config.idle_hours * 3600)
+    except Exception:
+        log.exception("チケットチャンネルの作成に失敗しました")
+    finally:
+        # 失敗時はNoneを渡し、待機中の重複リクエストを解放する
+        pending.set_result(ticket_channel)
+        del pending_tickets[key]
+
+    if ticket_channel is None:
+        await run_stage("confirm", interaction.followup.send, "チケットの作成に失敗しました。時間をおいてもう一度お試しください。", ephemeral=True)
+        return
 
+    # 設定から組み立て済みのテンプレートに、ユーザーごとの項目だけを埋める
+    template = get_template(guild, "open")
+    embed = template["embed"].copy().set_thumbnail(url=avatar_url(interaction.user))
     if answers:
-        description += "\n\n" + "\n".join([f"{key}: {value}" for key, value in answers.items()])
-
-    await interaction.response.send_message(
-        embed=discord.Embed(
-            title="🎫 チケットが作成されました。",
-            description="下のボタンをクリックしてアクセスしてください。",
-            color=color
-        ).set_author(
-            name=interaction.user.name,
-            icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-        ),
-        view=VisitTicketView(ticket_channel),
-        ephemeral=True,
-    )
+        embed.description += "\n\n" + "\n".join([f"{key}: {value}" for key, value in answers.items()])
 
-    embed = discord.Embed(
-        title=embed_title,
-        description=description,
-        color=color
-    ).set_author(
-        name=guild.name, icon_url=guild.icon.url if guild.icon else None
-    ).set_thumbnail(
-        url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    if image_url:
-        embed.set_image(url=image_url)
+    async def send_welcome():
+        # 送信後の添付ファイルは閉じられるので、再試行のたびに作り直す
+        files = await attach_image(embed, template["image"])
+        return await rest_scheduler.submit(
+            guild.id,
+            "send",
+            PRIORITY_CREATE,
+            ticket_channel.send,
+            f"{interaction.user.mention} {template['staff_mention']}",
+            embed=embed,
+            view=shared_view(CloseTicketView),
+            files=files,
+            channel_id=ticket_channel.id
+        )
+
+    try:
+        message = await run_stage("welcome", send_welcome)
+        remember_upload(template["image"], message)
+    except Exception:
+        # チャンネルはできているので、案内の送信に失敗しても作成完了は知らせる
+        log.exception("チケットチャンネルへの案内の送信に失敗しました")
 
-    await ticket_channel.send(
-        f"{interaction.user.mention} {staff_role.mention if staff_role else ''}",
-        embed=embed,
-        view=CloseTicketView()
+    await run_stage(
+        "confirm",
+        interaction.followup.send,
+        embed=template["created"].copy().set_author(name=interaction.user.name, icon_url=avatar_url(interaction.user)),
+        view=VisitTicketView(ticket_channel),
+        ephemeral=True,
     )
 
 class VisitTicketView(discord.ui.View):
@@ -175,62 +2038,423 @@ class VisitTicketView(discord.ui.View):
             url=ticket_channel.jump_url
         ))
 
-class CloseTicketView(discord.ui.View):
-    @discord.ui.button(label="Pin チケット", style=discord.ButtonStyle.green, custom_id="pin_ticket", emoji="📌")
-    async def pin_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
-        staff_role = discord.utils.get(interaction.guild.roles, id=settings["staff_role"].get(interaction.guild.id))
-        if staff_role not in interaction.user.roles:
+class PinTicketButton(discord.ui.DynamicItem[discord.ui.Button], template=r"pin_ticket"):
+    def __init__(self):
+        super().__init__(discord.ui.Button(label="Pin チケット", style=discord.ButtonStyle.green, custom_id="pin_ticket", emoji="📌"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls()
+
+    @instrumented("pin_ticket")
+    async def callback(self, interaction: discord.Interaction):
+        # ロールはインタラクションに含まれるので、メンバーのキャッシュが無くても確認できる
+        staff_role_id = get_config(interaction.guild.id).staff_role
+        if staff_role_id is None or interaction.user.get_role(staff_role_id) is None:
             await interaction.response.send_message("この操作を行う権限がありません。", ephemeral=True)
             return
-        await interaction.channel.edit(name=f"📌{interaction.channel.name}")
-        await interaction.response.send_message("チケットがピンされました。", ephemeral=True)
+        if interaction.channel.id not in ticket_owners:
+            await interaction.response.send_message("このチャンネルはチケットではありません。", ephemeral=True)
+            return
+        # 名前の変更は予算待ちになることがあるので先に応答を保留する
+        await interaction.response.defer(ephemeral=True)
+        channel = await rest_scheduler.submit(
+            interaction.guild.id, "edit", PRIORITY_UPDATE, interaction.channel.edit,
+            name=f"📌{interaction.channel.name}", channel_id=interaction.channel.id
+        )
+        if channel is not None:
+            record_pinned(channel)
+            await interaction.followup.send("チケットがピンされました。", ephemeral=True)
+
+class CloseTicketButton(discord.ui.DynamicItem[discord.ui.Button], template=r"close_ticket"):
+    def __init__(self):
+        super().__init__(discord.ui.Button(label="チケットを閉じる", style=discord.ButtonStyle.danger, custom_id="close_ticket", emoji="❎"))
 
-    @discord.ui.button(label="チケットを閉じる", style=discord.ButtonStyle.danger, custom_id="close_ticket", emoji="❎")
-    async def close_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls()
+
+    @instrumented("close_ticket")
+    async def callback(self, interaction: discord.Interaction):
         embed = discord.Embed(
             title="チケットを閉じますか？",
             description="本当にこのチケットを閉じますか？",
             color=discord.Color.red()
         )
-        await interaction.response.send_message(embed=embed, view=ConfirmCloseView(), ephemeral=True)
+        await interaction.response.send_message(embed=embed, view=shared_view(ConfirmCloseView), ephemeral=True)
+
+class CloseTicketView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.add_item(PinTicketButton())
+        self.add_item(CloseTicketButton())
+
+class ConfirmCloseButton(discord.ui.DynamicItem[discord.ui.Button], template=r"ticket:confirm_close"):
+    def __init__(self):
+        super().__init__(discord.ui.Button(label="はい", style=discord.ButtonStyle.danger, custom_id="ticket:confirm_close"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls()
+
+    @instrumented("confirm_close")
+    async def callback(self, interaction: discord.Interaction):
+        # DMと削除はワーカーに任せ、ここではすぐに応答する
+        if enqueue_close(interaction.channel, interaction.user.id, interaction.user):
+            await interaction.response.send_message("チケットを閉じています…", ephemeral=True)
+        else:
+            await interaction.response.send_message("このチケットは既に閉じる処理中です。", ephemeral=True)
+
+class CancelCloseButton(discord.ui.DynamicItem[discord.ui.Button], template=r"ticket:cancel_close"):
+    def __init__(self):
+        super().__init__(discord.ui.Button(label="いいえ", style=discord.ButtonStyle.secondary, custom_id="ticket:cancel_close"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls()
+
+    @instrumented("cancel_close")
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_message("キャンセルしました。", ephemeral=True)
 
 class ConfirmCloseView(discord.ui.View):
-    @discord.ui.button(label="はい", style=discord.ButtonStyle.danger)
-    async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
-        dm_message = settings["dm_message"].get(interaction.guild.id, "")
-        ticket_link = settings["link"].get(interaction.guild.id, "")
-        image_file = settings["close_image"].get(interaction.guild.id)
-        if dm_message:
-            embed = discord.Embed(
-                title="📄チケットが閉じました", description=dm_message, color=discord.Color.red()
-            ).set_author(
-                name=interaction.guild.name,
-                icon_url=interaction.guild.icon.url if interaction.guild.icon else None
-            ).add_field(
-                name="作成者", value=f"{interaction.user.mention}\nID: {interaction.user.id}", inline=False
-            ).add_field(
-                name="作成日時", value=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), inline=False
-            ).set_thumbnail(
-                url=interaction.user.avatar.url if interaction.user.avatar else None
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.add_item(ConfirmCloseButton())
+        self.add_item(CancelCloseButton())
+
+# 送信用のレイアウトは種類ごとに1つだけ作って使い回す
+shared_views = {}
+
+def shared_view(view_class):
+    view = shared_views.get(view_class)
+    if view is None:
+        view = shared_views[view_class] = view_class()
+    return view
+
+class CloseJob:
+    # 閉じるチケット1つ分。user は閉鎖DMの送り先（キャッシュに無ければワーカーで取得する）
+    # owner_id はチケットの作成者、transcript は保存したトランスクリプトのパス
+    __slots__ = ("channel", "user_id", "user", "owner_id", "transcript")
+
+    def __init__(self, channel, user_id, user=None, owner_id=None):
+        self.channel = channel
+        self.user_id = user_id
+        self.user = user
+        self.owner_id = owner_id
+        self.transcript = None
+
+close_queue = asyncio.Queue()
+delete_queue = asyncio.Queue()
+# 閉じる処理が始まったチャンネル（確認ボタンの連打などで二重に処理しない）
+closing_tickets = set()
+
+def enqueue_close(channel, user_id, user=None):
+    if channel.id in closing_tickets:
+        return False
+    closing_tickets.add(channel.id)
+    # 登録簿・統計・自動クローズの状態は削除が済むまで残す。途中で失敗したらチケットは開いたままになる
+    owner = ticket_owners.get(channel.id)
+    close_queue.put_nowait(CloseJob(channel, user_id, user, owner[1] if owner else None))
+    return True
+
+def finish_close(channel):
+    # チャンネルを削除できたので、閉じたチケットとして数えて登録簿から外す
+    closing_tickets.discard(channel.id)
+    record_closed(channel)
+    unregister_ticket(channel.id)
+    rest_scheduler.forget_channel(channel.id)
+
+def abort_close(channel, reason):
+    # 閉じられなかったチケットは開いたまま残す。自動クローズの対象なら待ち時間を数え直す
+    closing_tickets.discard(channel.id)
+    state = idle_tickets.get(channel.id)
+    if state is not None:
+        touch_idle(channel.id)
+        schedule_idle(channel.id, state)
+    # 「閉じています…」と応答済みなので、閉じられなかったことをチケット内で知らせる
+    spawn(notify_close_failed(channel, reason))
+
+async def notify_close_failed(channel, reason):
+    try:
+        await rest_scheduler.submit(
+            channel.guild.id, "send", PRIORITY_UPDATE, channel.send,
+            f"{reason}ため、チケットを閉じられませんでした。時間をおいてもう一度閉じてください。",
+            channel_id=channel.id
+        )
+    except discord.HTTPException as error:
+        log.warning("チケット %s に閉じられなかったことを知らせられませんでした: %s", channel.id, error)
+
+class TranscriptWriter:
+    # gzip圧縮のJSONLにページ単位で追記する。メソッドはトランスクリプト用スレッドで実行する
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.count = 0
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = gzip.open(f"{self.path}.tmp", "wt", encoding="utf-8")
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += len(records)
+
+    def close(self):
+        self.file.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+        try:
+            os.remove(f"{self.path}.tmp")
+        except FileNotFoundError:
+            pass
+
+class SearchIndex:
+    # トランスクリプトのメッセージ1件を1行とするFTS5索引。search() は検索用スレッド、それ以外は索引用スレッドで実行する
+    # 日本語は単語で区切れないので trigram で3文字単位に索引する
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.reader = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path)
+        # WALにして、索引への書き込み中も検索用の接続から読めるようにする
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+            "content, author, guild_id UNINDEXED, channel_id UNINDEXED, author_id UNINDEXED, created_at UNINDEXED, "
+            "tokenize='trigram');"
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            "path TEXT PRIMARY KEY, guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, name TEXT, closed_at TEXT, "
+            "indexed INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS transcripts_channel ON transcripts (channel_id);"
+        )
+
+    def index_transcript(self, entry):
+        # 索引済みの行数はメッセージと同じトランザクションで記録するので、途中で落ちても続きから再開できる
+        path = entry["path"]
+        row = self.conn.execute("SELECT indexed, done FROM transcripts WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO transcripts (path, guild_id, channel_id, name, closed_at) VALUES (?, ?, ?, ?, ?)",
+                    (path, entry["guild_id"], entry["channel_id"], entry.get("name"), entry.get("closed_at"))
+                )
+            indexed = 0
+        elif row[1]:
+            return
+        else:
+            indexed = row[0]
+        try:
+            f = gzip.open(path, "rt", encoding="utf-8")
+        except FileNotFoundError:
+            log.warning("トランスクリプト %s が見つからないため索引に入れません", path)
+            return
+        with f:
+            batch, position = [], 0
+            for position, line in enumerate(f, 1):
+                if position <= indexed:
+                    continue
+                record = json.loads(line)
+                if record["content"]:
+                    batch.append((
+                        record["content"], record["author"], entry["guild_id"], entry["channel_id"],
+                        record["author_id"], record["created_at"]
+                    ))
+                if len(batch) >= SEARCH_BATCH:
+                    self.commit(path, batch, position)
+                    batch = []
+            self.commit(path, batch, max(position, indexed), done=True)
+
+    def commit(self, path, rows, indexed, done=False):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO messages (content, author, guild_id, channel_id, author_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
             )
-            if image_file:
-                if hasattr(image_file, "url"):
-                    embed.set_image(url=image_file.url)
-                elif isinstance(image_file, str):
-                    embed.set_image(url=image_file)
-            view = discord.ui.View()
-            if ticket_link:
-                view.add_item(discord.ui.Button(
-                    label="チケットをもう一度作成する",
-                    style=discord.ButtonStyle.primary,
-                    url=ticket_link
-                ))
-            await interaction.user.send(embed=embed, view=view)
-        await interaction.channel.delete()
-
-    @discord.ui.button(label="いいえ", style=discord.ButtonStyle.secondary)
-    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.send_message("キャンセルしました。", ephemeral=True)
+            self.conn.execute("UPDATE transcripts SET indexed = ?, done = ? WHERE path = ?", (indexed, int(done), path))
+
+    def resume(self, index_path):
+        # 起動時に、保存済みのトランスクリプトのうち索引に入りきっていないものを入れ直す
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.index_transcript(entry)
+
+    def open_reader(self):
+        self.reader = sqlite3.connect(self.path)
+
+    def search(self, guild_id, query, limit, offset):
+        # 新しく閉じたチケットから順に返す（rowid順なのでヒット数が多くても全件は並べ替えない）
+        phrase = '"' + query.replace('"', '""') + '"'
+        return self.reader.execute(
+            "SELECT channel_id, (SELECT name FROM transcripts WHERE transcripts.channel_id = messages.channel_id), "
+            "author, created_at, snippet(messages, 0, '**', '**', '…', 16) "
+            "FROM messages WHERE messages MATCH ? AND guild_id = ? ORDER BY rowid DESC LIMIT ? OFFSET ?",
+            (f"content : {phrase}", guild_id, limit, offset)
+        ).fetchall()
+
+search_index = SearchIndex(SEARCH_DB)
+
+async def run_search(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(search_executor, func, *args)
+
+async def run_query(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(query_executor, func, *args)
+
+def _log_search_error(future):
+    if future.exception() is not None:
+        log.error("検索索引の更新に失敗しました", exc_info=future.exception())
+
+def submit_search(func, *args):
+    future = search_executor.submit(func, *args)
+    future.add_done_callback(_log_search_error)
+    return future
+
+transcript_semaphore = asyncio.Semaphore(TRANSCRIPT_CONCURRENCY)
+
+async def run_transcript(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(transcript_executor, func, *args)
+
+def message_record(message):
+    return {
+        "id": message.id,
+        "author_id": message.author.id,
+        "author": str(message.author),
+        "created_at": message.created_at.isoformat(),
+        "content": message.content,
+        "attachments": [attachment.url for attachment in message.attachments],
+        "embeds": [embed.to_dict() for embed in message.embeds],
+    }
+
+async def archive_transcript(channel, owner_id=None):
+    # 履歴を古い順に1ページずつ読み、そのページを書き終えてから次を読むので
+    # チケットの長さに関係なくメモリには1ページ分しか載らない
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(TRANSCRIPT_DIR, str(channel.guild.id), f"{channel.id}_{timestamp}.jsonl.gz")
+    writer = TranscriptWriter(path)
+    async with transcript_semaphore:
+        await run_transcript(writer.open)
+        try:
+            page = []
+            async for message in channel.history(limit=None, oldest_first=True):
+                page.append(message_record(message))
+                if len(page) >= TRANSCRIPT_PAGE:
+                    await run_transcript(writer.write, page)
+                    page = []
+            if page:
+                await run_transcript(writer.write, page)
+            await run_transcript(writer.close)
+        except BaseException:
+            await run_transcript(writer.abort)
+            raise
+    entry = {
+        "guild_id": channel.guild.id,
+        "channel_id": channel.id,
+        "name": channel.name,
+        "owner_id": owner_id,
+        "closed_at": timestamp,
+        "messages": writer.count,
+        "path": path,
+    }
+    submit_io(append_jsonl, TRANSCRIPT_INDEX, entry)
+    submit_search(search_index.index_transcript, entry)
+    return path
+
+async def send_close_dm(job):
+    template = get_template(job.channel.guild, "close")
+    if not template["enabled"] or job.user_id is None:
+        return
+    user = job.user
+    if user is None:
+        user = bot.get_user(job.user_id) or await run_stage("fetch_user", bot.fetch_user, job.user_id)
+    embed = template["embed"].copy().add_field(
+        name="作成者", value=f"{user.mention}\nID: {user.id}", inline=False
+    ).add_field(
+        name="作成日時", value=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), inline=False
+    ).set_thumbnail(
+        url=avatar_url(user)
+    )
+    if job.transcript:
+        # サーバー内のファイルの場所は利用者には開けないので、スタッフに伝えられる参照番号だけを載せる
+        reference = os.path.basename(job.transcript).split(".")[0]
+        embed.add_field(name="トランスクリプト", value=f"保存済み（参照番号: `{reference}`）\n問い合わせの際はスタッフにお伝えください。", inline=False)
+
+    async def send():
+        # 送信後の添付ファイルは閉じられるので、再試行のたびに作り直す
+        files = await attach_image(embed, template["image"])
+        return await user.send(embed=embed, view=template["view"], files=files)
+
+    try:
+        message = await run_stage("close_dm", send)
+    except discord.HTTPException as error:
+        # DMを受け付けていない・再試行しても届かない場合は記録だけ残し、削除は続ける
+        log.warning("閉鎖DMを送れませんでした (user=%s): %s", job.user_id, error)
+        submit_io(append_jsonl, DEAD_LETTER_PATH, {
+            "ts": datetime.utcnow().strftime("%Y%m%d_%H%M%S"),
+            "guild_id": job.channel.guild.id,
+            "channel_id": job.channel.id,
+            "user_id": job.user_id,
+            "error": str(error),
+            "embed": embed.to_dict(),
+        })
+        return
+    remember_upload(template["image"], message)
+
+async def close_worker():
+    while True:
+        job = await close_queue.get()
+        handler_labels.set(("close_worker", metric_guild(job.channel.guild.id)))
+        try:
+            if TRANSCRIPT_MODE:
+                try:
+                    job.transcript = await run_stage("transcript", archive_transcript, job.channel, job.owner_id)
+                except Exception:
+                    # 履歴を残せないまま消さないよう、チャンネルは残して閉じ直してもらう
+                    log.exception("チケット %s のトランスクリプトを保存できませんでした", job.channel.id)
+                    abort_close(job.channel, "トランスクリプトを保存できなかった")
+                    continue
+            try:
+                await send_close_dm(job)
+            except Exception:
+                log.exception("閉鎖DMの処理中にエラーが発生しました")
+            delete_queue.put_nowait(job.channel)
+        finally:
+            close_queue.task_done()
+
+async def delete_worker():
+    # 溜まっている削除をまとめて投入し、スケジューラーの予算内で一括して流す
+    handler_labels.set(("delete_worker", "0"))
+    while True:
+        batch = [await delete_queue.get()]
+        while len(batch) < CLOSE_DELETE_BATCH and not delete_queue.empty():
+            batch.append(delete_queue.get_nowait())
+        results = await asyncio.gather(*(
+            rest_scheduler.submit(channel.guild.id, "delete", PRIORITY_CLEANUP, channel.delete, channel_id=channel.id)
+            for channel in batch
+        ), return_exceptions=True)
+        for channel, result in zip(batch, results):
+            if isinstance(result, Exception) and not isinstance(result, discord.NotFound):
+                log.warning("チケット %s を削除できませんでした: %s", channel.id, result)
+                abort_close(channel, "チャンネルを削除できなかった")
+            else:
+                finish_close(channel)
+            delete_queue.task_done()
+
+def start_close_workers():
+    for _ in range(CLOSE_WORKERS):
+        spawn(close_worker())
+    spawn(delete_worker())
 
 @bot.tree.command(name="ticket_button", description="チケット作成ボタンとスタッフロールおよび閲覧可能ロールを設定します。")
 @app_commands.describe(
@@ -238,9 +2462,12 @@ class ConfirmCloseView(discord.ui.View):
     name="ボタンの名前",
     description="ボタンの説明",
     staff_role="通知するスタッフロール（@メンション）",
-    ticket_role="チケットを閲覧できる追加ロール（@メンション）"
+    ticket_role="チケットを閲覧できる追加ロール（@メンション）",
+    pool_size="事前に作成しておくチャンネル数（0で作成しない）",
+    idle_hours="発言がないまま自動で閉じるまでの時間（0で閉じない）"
 )
-async def ticket_button_command(interaction: discord.Interaction, emoji: str, name: str, description: str, staff_role: discord.Role, ticket_role: discord.Role):
+@instrumented("ticket_button")
+async def ticket_button_command(interaction: discord.Interaction, emoji: str, name: str, description: str, staff_role: discord.Role, ticket_role: discord.Role, pool_size: app_commands.Range[int, 0, 10] = 0, idle_hours: app_commands.Range[int, 0, 720] = 0):
     category_options = [discord.SelectOption(label=category.name, value=str(category.id))
                         for category in interaction.guild.categories]
 
@@ -253,21 +2480,14 @@ async def ticket_button_command(interaction: discord.Interaction, emoji: str, na
         def __init__(self):
             super().__init__(placeholder="カテゴリーを選択してください...", options=category_options)
 
+        @instrumented("ticket_button_category")
         async def callback(self, interaction: discord.Interaction):
             category_id = int(self.values[0])
-            if interaction.guild.id not in settings["ticket"]:
-                settings["ticket"][interaction.guild.id] = []
             # ボタンごとの設定情報にticket_roleも追加する
-            settings["ticket"][interaction.guild.id].append(
-                {
-                    "category": category_id,
-                    "emoji": emoji,
-                    "name": name,
-                    "description": description,
-                    "ticket_role": ticket_role.id
-                }
-            )
-            settings["staff_role"][interaction.guild.id] = staff_role.id
+            buttons = get_config(interaction.guild.id).ticket + [
+                TicketButton(category_id, emoji, name, description, ticket_role.id, pool_size, idle_hours)
+            ]
+            set_settings(interaction.guild.id, ticket=buttons, staff_role=staff_role.id)
             await interaction.response.send_message(
                 f"ボタン '{name}' (カテゴリー: {category_id}, 絵文字: {emoji}) とスタッフロール '{staff_role.name}'、閲覧可能ロール '{ticket_role.name}' を追加しました。",
                 ephemeral=True,
@@ -276,6 +2496,7 @@ async def ticket_button_command(interaction: discord.Interaction, emoji: str, na
     await interaction.response.send_message("カテゴリーを選択してください：", view=CategorySelectView(), ephemeral=True)
 
 @bot.tree.command(name="ticket_title", description="チケットパネルのタイトルと説明を設定します。")
+@instrumented("ticket_title")
 async def ticket_title_command(interaction: discord.Interaction):
     class TicketModal(discord.ui.Modal, title="チケットパネル設定"):
         title_field = discord.ui.TextInput(
@@ -297,16 +2518,16 @@ async def ticket_title_command(interaction: discord.Interaction):
             required=False,
         )
 
+        @instrumented("ticket_title_modal")
         async def on_submit(self, interaction: discord.Interaction):
             title = self.title_field.value
             title_url = self.title_url_field.value
-            if title_url:
-                settings["panel_title"][interaction.guild.id] = title
-                settings["panel_url"][interaction.guild.id] = title_url
-            else:
-                settings["panel_title"][interaction.guild.id] = title
-                settings["panel_url"][interaction.guild.id] = None
-            settings["panel_description"][interaction.guild.id] = self.description_field.value
+            set_settings(
+                interaction.guild.id,
+                panel_title=title,
+                panel_url=title_url or None,
+                panel_description=self.description_field.value,
+            )
             await interaction.response.send_message(
                 f"チケットパネルのタイトルを '{self.title_field.value}' に、説明を設定しました。",
                 ephemeral=True
@@ -314,6 +2535,7 @@ async def ticket_title_command(interaction: discord.Interaction):
     await interaction.response.send_modal(TicketModal())
 
 @bot.tree.command(name="open_ticket_settings", description="チケットが送信されたときのEmbedカラー、タイトル、説明を設定します。")
+@instrumented("open_ticket_settings")
 async def open_ticket_settings_command(interaction: discord.Interaction):
     class OpenTicketModal(discord.ui.Modal, title="チケット設定"):
         title_field = discord.ui.TextInput(
@@ -335,6 +2557,7 @@ async def open_ticket_settings_command(interaction: discord.Interaction):
             required=True,
         )
 
+        @instrumented("open_ticket_settings_modal")
         async def on_submit(self, interaction: discord.Interaction):
             color_dict = {
                 "赤": discord.Color.red(),
@@ -343,50 +2566,32 @@ async def open_ticket_settings_command(interaction: discord.Interaction):
                 "緑": discord.Color.green()
             }
             embed_color = color_dict.get(self.color_field.value, discord.Color.blue())
-            settings["embed_title"][interaction.guild.id] = self.title_field.value
-            settings["embed_description"][interaction.guild.id] = self.description_field.value
-            settings["embed_color"][interaction.guild.id] = embed_color
+            set_settings(
+                interaction.guild.id,
+                embed_title=self.title_field.value,
+                embed_description=self.description_field.value,
+                embed_color=embed_color,
+            )
             await interaction.response.send_message("チケットのEmbed設定を保存しました。", ephemeral=True)
     await interaction.response.send_modal(OpenTicketModal())
 
 @bot.tree.command(name="ticket_panel", description="チケットパネルを作成します。")
+@instrumented("ticket_panel")
 async def ticket_panel_command(interaction: discord.Interaction):
-    buttons = settings["ticket"].get(interaction.guild.id, [])
-    if not buttons:
+    if not get_config(interaction.guild.id).ticket:
         await interaction.response.send_message("チケットのボタンが設定されていません！", ephemeral=True)
         return
-    guild_info = settings["developed_info"].get(interaction.guild.id, {})
-    panel_title = settings["panel_title"].get(interaction.guild.id, "チケットサポート")
-    panel_description = settings["panel_description"].get(interaction.guild.id, "以下のボタンを押してチケットを開いてください。")
-    panel_url = settings["panel_url"].get(interaction.guild.id)
-    if panel_url:
-        embed = discord.Embed(
-            title=panel_title,
-            url=panel_url,
-            description=panel_description,
-            color=settings["panel_color"].get(interaction.guild.id, discord.Color.blue())
-        )
-    else:
-        embed = discord.Embed(
-            title=panel_title,
-            description=panel_description,
-            color=settings["panel_color"].get(interaction.guild.id, discord.Color.blue())
-        )
-    embed.set_author(name=interaction.guild.name, icon_url=interaction.guild.icon.url if interaction.guild.icon else None)
-    if guild_info:
-        embed.set_footer(text=guild_info.get("text"), icon_url=guild_info.get("icon_url"))
-    # Check if panel_image is stored as an attachment or a URL string
-    if settings["panel_image"].get(interaction.guild.id):
-        image_obj = settings["panel_image"][interaction.guild.id]
-        if hasattr(image_obj, "filename"):
-            embed.set_image(url=f"attachment://{image_obj.filename}")
-        else:
-            embed.set_image(url=image_obj)
-    view = TicketView(buttons)
-    await interaction.channel.send(embed=embed, view=view)
-    await interaction.response.send_message("チケットパネルを作成しました。", ephemeral=True)
+    # 画像の読み込みはI/Oスレッドでスナップショットの保存の後ろに並ぶことがあるので、先に応答を保留する
+    await interaction.response.defer(ephemeral=True)
+    template = get_template(interaction.guild, "panel")
+    embed = template["embed"].copy()
+    files = await attach_image(embed, template["image"])
+    message = await interaction.channel.send(embed=embed, view=template["view"], files=files)
+    remember_upload(template["image"], message)
+    await interaction.followup.send("チケットパネルを作成しました。", ephemeral=True)
 
 @bot.tree.command(name="ticket_dm", description="チケットを開いた際にDMで送信する内容を設定します。")
+@instrumented("ticket_dm")
 async def ticket_dm_command(interaction: discord.Interaction):
     class DmModal(discord.ui.Modal, title="DMメッセージ設定"):
         message_field = discord.ui.TextInput(
@@ -401,9 +2606,9 @@ async def ticket_dm_command(interaction: discord.Interaction):
             placeholder="例: https://discord.com/channels/...",
             required=True,
         )
+        @instrumented("ticket_dm_modal")
         async def on_submit(self, interaction: discord.Interaction):
-            settings["dm_message"][interaction.guild.id] = self.message_field.value
-            settings["link"][interaction.guild.id] = self.link_field.value
+            set_settings(interaction.guild.id, dm_message=self.message_field.value, link=self.link_field.value)
             await interaction.response.send_message("DMメッセージとチケットリンクを設定しました。", ephemeral=True)
     await interaction.response.send_modal(DmModal())
 
@@ -413,7 +2618,10 @@ async def ticket_dm_command(interaction: discord.Interaction):
     color="パネルの埋め込みカラー（赤、青、黄色、緑から選択）",
     top_right_image_file="パネルの右上に表示する画像のファイル"
 )
+@instrumented("ticket_settings")
 async def ticket_settings_command(interaction: discord.Interaction, image_file: discord.Attachment, color: str, top_right_image_file: discord.Attachment):
+    # 画像の取得に時間がかかることがあるので先に応答を保留する
+    await interaction.response.defer(ephemeral=True)
     color_dict = {
         "赤": discord.Color.red(),
         "青": discord.Color.blue(),
@@ -421,118 +2629,416 @@ async def ticket_settings_command(interaction: discord.Interaction, image_file:
         "緑": discord.Color.green()
     }
     embed_color = color_dict.get(color, discord.Color.blue())
-    settings["panel_image"][interaction.guild.id] = image_file
-    settings["panel_color"][interaction.guild.id] = embed_color
-    settings["top_right_image"][interaction.guild.id] = top_right_image_file
-    await interaction.response.send_message("チケットパネルの設定を保存しました。", ephemeral=True)
+    set_settings(
+        interaction.guild.id,
+        panel_image=await cache_image(image_file),
+        panel_color=embed_color,
+        top_right_image=await cache_image(top_right_image_file),
+    )
+    await interaction.followup.send("チケットパネルの設定を保存しました。", ephemeral=True)
 
 @bot.tree.command(name="ticket_embed_settings", description="チケットを開いた時と閉じた時のembedに画像を追加します。")
 @app_commands.describe(
     open_image_file="チケットを開いた時のembedに表示する画像のファイル",
     close_image_file="チケットを閉じた時のembedに表示する画像のファイル"
 )
+@instrumented("ticket_embed_settings")
 async def ticket_embed_settings_command(interaction: discord.Interaction, open_image_file: discord.Attachment, close_image_file: discord.Attachment):
-    settings["open_image"][interaction.guild.id] = open_image_file
-    settings["close_image"][interaction.guild.id] = close_image_file
-    await interaction.response.send_message("チケットのembed画像設定を保存しました。", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    set_settings(interaction.guild.id, open_image=await cache_image(open_image_file), close_image=await cache_image(close_image_file))
+    await interaction.followup.send("チケットのembed画像設定を保存しました。", ephemeral=True)
 
 @bot.tree.command(name="ticket_develop", description="チケットパネルの左下に表示する文章と画像を設定します。")
 @app_commands.describe(
     text="表示する文章",
     icon_url="表示するアイコンのURL"
 )
+@instrumented("ticket_develop")
 async def ticket_develop_command(interaction: discord.Interaction, text: str, icon_url: str):
-    settings["developed_info"][interaction.guild.id] = {"text": text, "icon_url": icon_url}
+    set_settings(interaction.guild.id, developed_info={"text": text, "icon_url": icon_url})
     await interaction.response.send_message("チケットパネルの開発者情報を設定しました。", ephemeral=True)
 
 @bot.tree.command(name="ticket_save", description="全ての設定した内容を保存します。")
+@instrumented("ticket_save")
 async def ticket_save_command(interaction: discord.Interaction):
-    def serialize_settings():
-        serialized = {}
-        for key, data in settings.items():
-            if isinstance(data, dict):
-                serialized[key] = {}
-                for guild_id, value in data.items():
-                    # Convert discord.Color to its integer value
-                    if isinstance(value, discord.Color):
-                        serialized[key][guild_id] = value.value
-                    # For attachments, store the URL if available
-                    elif hasattr(value, "url"):
-                        serialized[key][guild_id] = value.url
-                    else:
-                        serialized[key][guild_id] = value
-            else:
-                serialized[key] = data
-        return serialized
-
-    data = serialize_settings()
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    filename = os.path.join(SAVE_DIR, f"ticket_save_{timestamp}.json")
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-    await interaction.response.send_message(f"設定内容を保存しました。 (File: {os.path.basename(filename)})", ephemeral=True)
+    # サーバー数が多いと3秒の応答期限を過ぎるので、先に応答を保留する
+    await interaction.response.defer(ephemeral=True)
+    entry = await run_io(save_settings_snapshot, list(guild_configs.items()), datetime.utcnow().strftime("%Y%m%d_%H%M%S"))
+    await interaction.followup.send(f"設定内容を保存しました。 (File: {entry['file']})", ephemeral=True)
 
 class SaveSelect(discord.ui.Select):
-    def __init__(self, files):
+    def __init__(self, entries):
         options = [
-            discord.SelectOption(label=filename, value=filename)
-            for filename in files
+            discord.SelectOption(
+                label=entry["file"],
+                value=entry["file"],
+                description=f"{entry['timestamp']} / {entry['size'] / 1024:.1f} KB / {entry['guild_count']} サーバー / {entry['sha256'][:12]}"
+            )
+            for entry in entries
         ]
-        super().__init__(placeholder="ロードする保存ファイルを選択してください...", options=options)
+        super().__init__(placeholder="ロードする保存ファイルを選択してください...", options=options, row=0)
 
+    @instrumented("ticket_road_select")
     async def callback(self, interaction: discord.Interaction):
         selected_file = self.values[0]
-        filepath = os.path.join(SAVE_DIR, selected_file)
-        if not os.path.exists(filepath):
-            await interaction.response.send_message("選択されたファイルが見つかりません。", ephemeral=True)
+        # 読み込みはI/Oスレッドでスナップショットの保存の後ろに並ぶことがあるので、先に応答を保留する
+        await interaction.response.defer(ephemeral=True)
+        entry = next((e for e in save_catalog.entries if e["file"] == selected_file), None)
+        fields = await run_io(read_guild_slice, entry, interaction.guild.id) if entry else None
+        if fields is None:
+            await interaction.followup.send("選択されたファイルが見つかりません。", ephemeral=True)
             return
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        def load_settings_from_data(data):
-            for key, guild_data in data.items():
-                if isinstance(guild_data, dict):
-                    if key not in settings:
-                        settings[key] = {}
-                    for guild_id_str, value in guild_data.items():
-                        guild_id = int(guild_id_str)
-                        if key == "embed_color":
-                            settings[key][guild_id] = discord.Color(value)
-                        else:
-                            settings[key][guild_id] = value
-                else:
-                    settings[key] = guild_data
-
-        load_settings_from_data(data)
-        await interaction.response.send_message(f"{selected_file} から設定をロードしました。", ephemeral=True)
+        # このサーバーの設定だけを復元する
+        persist_rows(apply_guild_settings(interaction.guild.id, fields))
+        await interaction.followup.send(f"{selected_file} から設定をロードしました。", ephemeral=True)
 
 class RoadSelectView(discord.ui.View):
-    def __init__(self, files):
+    def __init__(self, entries):
         super().__init__(timeout=30)
-        self.add_item(SaveSelect(files))
+        self.entries = entries
+        self.page = 0
+        self.select = None
+        self.render()
+
+    @property
+    def page_count(self):
+        return (len(self.entries) + SAVES_PER_PAGE - 1) // SAVES_PER_PAGE
+
+    @property
+    def content(self):
+        return f"ロードするファイルを選んでください：（{self.page + 1}/{self.page_count} ページ）"
+
+    def render(self):
+        if self.select:
+            self.remove_item(self.select)
+        start = self.page * SAVES_PER_PAGE
+        self.select = SaveSelect(self.entries[start:start + SAVES_PER_PAGE])
+        self.add_item(self.select)
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    @discord.ui.button(label="前へ", style=discord.ButtonStyle.secondary, row=1)
+    @instrumented("ticket_road_prev")
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        self.render()
+        await interaction.response.edit_message(content=self.content, view=self)
+
+    @discord.ui.button(label="次へ", style=discord.ButtonStyle.secondary, row=1)
+    @instrumented("ticket_road_next")
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        self.render()
+        await interaction.response.edit_message(content=self.content, view=self)
 
 @bot.tree.command(name="ticket_road", description="保存済みの設定ファイルを一覧から選んでロードします。")
+@instrumented("ticket_road")
 async def ticket_road_command(interaction: discord.Interaction):
-    files = [f for f in os.listdir(SAVE_DIR) if f.endswith(".json")]
-    if not files:
-        await interaction.response.send_message("保存された設定ファイルが見つかりません。", ephemeral=True)
+    # 保存ごとの索引を読むので、I/Oスレッドに並ぶ前に応答を保留する
+    await interaction.response.defer(ephemeral=True)
+    entries = await run_io(save_catalog.for_guild, interaction.guild.id)
+    if not entries:
+        await interaction.followup.send("保存された設定ファイルが見つかりません。", ephemeral=True)
         return
-    view = RoadSelectView(files)
-    await interaction.response.send_message("ロードするファイルを選んでください：", view=view, ephemeral=True)
+    view = RoadSelectView(entries)
+    await interaction.followup.send(view.content, view=view, ephemeral=True)
+
+@bot.tree.command(name="ticket_restore", description="指定した時点の設定をスナップショットとジャーナルから復元します。")
+@app_commands.describe(timestamp="復元する時点（UTC、例: 20240101_120000）")
+@app_commands.default_permissions(manage_guild=True)
+@instrumented("ticket_restore")
+async def ticket_restore_command(interaction: discord.Interaction, timestamp: str):
+    if not JOURNAL_MODE:
+        await interaction.response.send_message("ジャーナルモードが無効です。", ephemeral=True)
+        return
+    # 時点は文字列のまま比べるので、形式の違う入力が全ての保存より後として扱われないよう先に確かめる
+    try:
+        # strptime は桁の足りない月日も受け付けるので、書き戻して同じ文字列になるものだけを通す
+        valid = datetime.strptime(timestamp, "%Y%m%d_%H%M%S").strftime("%Y%m%d_%H%M%S") == timestamp
+    except ValueError:
+        valid = False
+    if not valid:
+        await interaction.response.send_message("時点は 20240101_120000 の形式（UTC）で指定してください。", ephemeral=True)
+        return
+    # 復元はI/Oスレッドでスナップショットの保存の後ろに並ぶことがあるので、先に応答を保留する
+    await interaction.response.defer(ephemeral=True)
+    fields = await run_io(restore_guild, timestamp, interaction.guild.id)
+    if fields is None:
+        await interaction.followup.send("その時点以前のスナップショットが見つかりません。", ephemeral=True)
+        return
+    persist_rows(replace_guild_settings(interaction.guild.id, fields))
+    await interaction.followup.send(f"{timestamp} 時点の設定を復元しました。", ephemeral=True)
+
+class SearchResultsView(discord.ui.View):
+    def __init__(self, guild_id, query):
+        super().__init__(timeout=300)
+        self.guild_id = guild_id
+        self.query = query
+        self.page = 0
+        self.rows = []
+
+    async def load(self):
+        # 次のページがあるかを知るために1件多く取る
+        rows = await run_query(
+            search_index.search, self.guild_id, self.query,
+            SEARCH_RESULTS_PER_PAGE + 1, self.page * SEARCH_RESULTS_PER_PAGE
+        )
+        self.rows = rows[:SEARCH_RESULTS_PER_PAGE]
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = len(rows) <= SEARCH_RESULTS_PER_PAGE
+
+    @property
+    def embed(self):
+        embed = discord.Embed(title=f"🔎 「{self.query}」の検索結果（{self.page + 1} ページ）", color=discord.Color.blue())
+        if not self.rows:
+            embed.description = "見つかりませんでした。"
+        for channel_id, name, author, created_at, snippet in self.rows:
+            embed.add_field(
+                name=f"#{name or channel_id} ・ {author} ・ {created_at[:16].replace('T', ' ')}",
+                value=snippet[:1024],
+                inline=False
+            )
+        return embed
+
+    @discord.ui.button(label="前へ", style=discord.ButtonStyle.secondary)
+    @instrumented("ticket_search_prev")
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await interaction.response.defer()
+        await self.load()
+        await interaction.edit_original_response(embed=self.embed, view=self)
+
+    @discord.ui.button(label="次へ", style=discord.ButtonStyle.secondary)
+    @instrumented("ticket_search_next")
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await interaction.response.defer()
+        await self.load()
+        await interaction.edit_original_response(embed=self.embed, view=self)
+
+@bot.tree.command(name="ticket_search", description="閉じたチケットのトランスクリプトを全文検索します。")
+@app_commands.describe(query="検索する文字列（3文字以上）")
+@app_commands.default_permissions(manage_messages=True)
+@instrumented("ticket_search")
+async def ticket_search_command(interaction: discord.Interaction, query: str):
+    if len(query) < 3:
+        await interaction.response.send_message("3文字以上で検索してください。", ephemeral=True)
+        return
+    # ヒット数の多い検索は時間がかかることがあるので、先に応答を保留する
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    view = SearchResultsView(interaction.guild.id, query)
+    await view.load()
+    await interaction.followup.send(embed=view.embed, view=view, ephemeral=True)
+
+@bot.tree.command(name="ticket_stats", description="チケットの作成・ピン・クローズ数と、閉じるまでの時間を表示します。")
+@app_commands.describe(period="集計する期間")
+@app_commands.choices(period=[
+    app_commands.Choice(name="今日", value=1),
+    app_commands.Choice(name="1週間", value=7),
+    app_commands.Choice(name="1か月", value=30),
+])
+@instrumented("ticket_stats")
+async def ticket_stats_command(interaction: discord.Interaction, period: app_commands.Choice[int]):
+    stats = merge_stats(interaction.guild.id, period.value)
+    embed = discord.Embed(title=f"📊 チケット統計（{period.name}）", color=discord.Color.blue())
+    embed.add_field(name="作成", value=str(stats["opened"]))
+    embed.add_field(name="ピン", value=str(stats["pinned"]))
+    embed.add_field(name="クローズ", value=str(stats["closed"]))
+    if stats["closed"]:
+        hist = stats["close_hist"]
+        embed.add_field(
+            name="閉じるまでの時間",
+            value=(
+                f"平均: {format_duration(stats['close_total'] / stats['closed'])}\n"
+                f"中央値: {format_percentile(hist, 0.5)}\n"
+                f"90%: {format_percentile(hist, 0.9)}\n"
+                f"99%: {format_percentile(hist, 0.99)}"
+            ),
+            inline=False
+        )
+    buttons = get_config(interaction.guild.id).ticket
+    lines = []
+    for key, (opened, pinned, closed) in sorted(stats["buttons"].items(), key=lambda item: int(item[0])):
+        index = int(key)
+        name = buttons[index].name if 0 <= index < len(buttons) else "不明"
+        lines.append(f"{name}: 作成 {opened} / ピン {pinned} / クローズ {closed}")
+    if lines:
+        embed.add_field(name="ボタン別", value="\n".join(lines)[:1024], inline=False)
+    lines = [
+        f"<#{key}>: 作成 {opened} / ピン {pinned} / クローズ {closed}"
+        for key, (opened, pinned, closed) in stats["categories"].items()
+    ]
+    if lines:
+        embed.add_field(name="カテゴリー別", value="\n".join(lines)[:1024], inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="ticket_close_all", description="条件に合うオープン中のチケットをまとめて閉じます。")
+@app_commands.describe(
+    category="このカテゴリーのチケットだけを閉じる",
+    older_than_hours="開いてからこの時間（時間）以上経ったチケットだけを閉じる"
+)
+@app_commands.default_permissions(manage_channels=True)
+@instrumented("ticket_close_all")
+async def ticket_close_all_command(interaction: discord.Interaction, category: discord.CategoryChannel = None, older_than_hours: app_commands.Range[int, 0] = None):
+    now = time.time()
+    count = 0
+    for channel_id, (guild_id, user_id) in list(ticket_owners.items()):
+        channel = interaction.guild.get_channel(channel_id)
+        if guild_id != interaction.guild.id or channel is None:
+            continue
+        if category is not None and channel.category_id != category.id:
+            continue
+        if older_than_hours is not None:
+            # ウォームプールのチャンネルは作成よりずっと後に使われるので、チケットとして開いた時刻で比べる。
+            # 統計の導入前から開いていたチケットだけはチャンネルの作成時刻で代用する
+            info = ticket_info.get(channel_id)
+            opened_at = info[3] if info else channel.created_at.timestamp()
+            if now - opened_at < older_than_hours * 3600:
+                continue
+        if enqueue_close(channel, user_id):
+            count += 1
+    await interaction.response.send_message(f"{count}件のチケットを閉じています。", ephemeral=True)
+
+@tasks.loop(minutes=JOURNAL_COMPACT_MINUTES)
+async def compact_journal():
+    # 変更がなければスナップショットを増やさない
+    if settings_journal.pending:
+        await run_io(save_settings_snapshot, list(guild_configs.items()), datetime.utcnow().strftime("%Y%m%d_%H%M%S"))
+
+@bot.event
+async def setup_hook():
+    # 前回までの設定をSQLiteから読み込む（/ticket_road は不要）
+    # チケット関連のコンポーネントを登録する（再起動後も既存メッセージのボタンが動く）
+    bot.add_dynamic_items(TicketSelect, PinTicketButton, CloseTicketButton, ConfirmCloseButton, CancelCloseButton)
+    await run_io(os.makedirs, SAVE_DIR, exist_ok=True)
+    await run_io(settings_store.open)
+    load_settings_from_rows(await run_io(settings_store.load_all))
+    await run_io(save_catalog.open)
+    await run_io(image_cache.open)
+    await run_io(stats_store.open)
+    load_stats(
+        await run_io(stats_store.load, int(time.time() // 86400) - STATS_DAYS),
+        await run_io(stats_store.load_tickets)
+    )
+    await run_io(idle_store.open)
+    load_idle(await run_io(idle_store.load))
+    spawn(idle_scheduler())
+    flush_idle.start()
+    await run_search(search_index.open)
+    await run_query(search_index.open_reader)
+    submit_search(search_index.resume, TRANSCRIPT_INDEX)
+    start_close_workers()
+    if SLOW_CALLBACK_SECONDS:
+        watchdog.start(asyncio.get_running_loop())
+        spawn(monitor_loop_lag())
+    if PROFILE_MINUTES:
+        await run_io(os.makedirs, PROFILE_DIR, exist_ok=True)
+        start_profiling()
+    if METRICS_PORT:
+        await start_metrics_server()
+    if JOURNAL_MODE:
+        await run_io(settings_journal.open)
+        compact_journal.start()
+
+@bot.event
+async def on_connect():
+    # READYを受け直すとギルドのキャッシュが作り直されるので、揃うまで自動クローズを止める
+    guild_cache_ready.clear()
 
 @bot.event
 async def on_ready():
+    rebuild_ticket_registry()
+    guild_cache_ready.set()
     await bot.tree.sync()
+    if not refill_warm_pools.is_running():
+        refill_warm_pools.start()
     print(f"Logged in as {bot.user}")
 
+@bot.event
+async def on_guild_update(before, after):
+    # テンプレートにはサーバー名とアイコンが含まれる
+    invalidate_templates(after.id)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    # ボットを通さずに削除されたチケットも閉じたものとして数える（ボットが閉じている途中なら削除ワーカーが数える）
+    if channel.id in ticket_info and channel.id not in closing_tickets:
+        record_closed(channel)
+    unregister_ticket(channel.id)
+    rest_scheduler.forget_channel(channel.id)
+
+# URL返信の待ち行列: channel_id -> [url, ...]（送信予約済みのチャンネルだけが入る）
+pending_url_replies = {}
+# channel_id -> 最後にURLを返信した時刻
+last_url_replies = {}
+
+def queue_url_reply(channel, urls):
+    pending = pending_url_replies.get(channel.id)
+    if pending is not None:
+        pending.extend(urls)
+        return
+    pending_url_replies[channel.id] = list(urls)
+    spawn(send_url_reply(channel))
+
+def url_reply_messages(urls):
+    # Discordの1メッセージ2000文字に収まるように分ける
+    messages, content = [], "画像/ファイルのURLを取得しました:"
+    for url in urls:
+        if len(content) + 1 + len(url) > 2000:
+            messages.append(content)
+            content = url
+        else:
+            content += "\n" + url
+    messages.append(content)
+    return messages
+
+async def send_url_reply(channel):
+    # 集める時間を待ち、前回の返信から URL_REPLY_INTERVAL 経っていなければその分も待つ
+    delay = max(URL_REPLY_WINDOW, last_url_replies.get(channel.id, 0) + URL_REPLY_INTERVAL - time.monotonic())
+    await asyncio.sleep(delay)
+    urls = pending_url_replies.pop(channel.id)
+    sent_at = last_url_replies[channel.id] = time.monotonic()
+    try:
+        for content in url_reply_messages(urls):
+            await rest_scheduler.submit(channel.guild.id, "send", PRIORITY_UPDATE, channel.send, content, channel_id=channel.id)
+    except discord.HTTPException as error:
+        log.warning("チャンネル %s へのURLの返信に失敗しました: %s", channel.id, error)
+    # 間隔が過ぎれば記録は要らないので、次の返信が記録を更新していなければ消す
+    await asyncio.sleep(max(0, sent_at + URL_REPLY_INTERVAL - time.monotonic()))
+    if last_url_replies.get(channel.id) == sent_at:
+        del last_url_replies[channel.id]
+
+@bot.tree.command(name="ticket_url_channel", description="添付画像のURLを返信するチャンネルを追加・解除します。")
+@app_commands.describe(channel="切り替えるチャンネル")
+@app_commands.default_permissions(manage_channels=True)
+@instrumented("ticket_url_channel")
+async def ticket_url_channel_command(interaction: discord.Interaction, channel: discord.TextChannel):
+    channels = get_config(interaction.guild.id).url_channels
+    if channel.id in channels:
+        set_settings(interaction.guild.id, url_channels=channels - {channel.id})
+        await interaction.response.send_message(f"{channel.mention} での画像URLの返信を停止しました。", ephemeral=True)
+    else:
+        set_settings(interaction.guild.id, url_channels=channels | {channel.id})
+        await interaction.response.send_message(f"{channel.mention} で画像URLを返信します。", ephemeral=True)
+
 @bot.event
 async def on_message(message):
+    # 全チャンネルの全メッセージで呼ばれるので、対象外はできるだけ早く抜ける
     if message.author.bot:
         return
-    if message.attachments:
-        for attachment in message.attachments:
-            if attachment.url.lower().endswith(('png', 'jpg', 'jpeg', 'gif')):
-                await message.channel.send(f"画像/ファイルのURLを取得しました: {attachment.url}")
+    touch_idle(message.channel.id)
+    if message.attachments and message.guild is not None:
+        config = guild_configs.get(message.guild.id)
+        if config is not None and message.channel.id in config.url_channels:
+            # URLにはクエリ（署名）が付くので、拡張子はファイル名で判定する
+            urls = [
+                attachment.url for attachment in message.attachments
+                if attachment.filename.lower().endswith(URL_REPLY_EXTENSIONS)
+            ]
+            if urls:
+                queue_url_reply(message.channel, urls)
     await bot.process_commands(message)
 
-bot.run("YOUR_BOT_TOKEN")
\ No newline at end of file
+# 画像処理プロセスが本モジュールを読み込んでもBotを起動しないようにする
+if __name__ == "__main__":
+    bot.run("YOUR_BOT_TOKEN")